@@ -0,0 +1,215 @@
+"""Outbox for anchoring stories and votes on the blockchain.
+
+Stories are created with a pending (NULL) story_hash and an anchoring Job that
+holds the blockchain payload. The worker thread started in apps.py submits
+pending payloads outside of request transactions, retrying failures with
+exponential backoff. Each payload carries an idempotency key so that a retry
+of a request that did reach the API doesn't add a second block. Every process
+runs a worker, so a job is claimed in the database before it's submitted.
+
+Story votes are marked anchor_pending and collected into a VoteBatch once the
+oldest of them is VOTE_BATCH_WINDOW seconds old. Only the batch's Merkle root
+is anchored, and each vote keeps its inclusion proof, see sic/merkle.py.
+"""
+
+import json
+import logging
+import threading
+import uuid
+from datetime import datetime, timedelta
+from django.apps import apps
+from django.db import transaction
+from django.utils.timezone import make_aware
+
+from sic import merkle
+from sic.jobs import Job, JobKind
+from sic.models import Story, Vote, VoteBatch
+
+config = apps.get_app_config("sic")
+
+logger = logging.getLogger("sic")
+
+wake = threading.Event()
+
+
+def enqueue(func, data: dict):
+    """Queue an anchoring job once the current transaction commits."""
+    Job.objects.create(
+        kind=JobKind.from_func(func),
+        periodic=False,
+        data={
+            **data,
+            "idempotency_key": uuid.uuid4().hex,
+            "attempts": 0,
+            "next_attempt": None,
+        },
+    )
+    transaction.on_commit(wake.set)
+
+
+def enqueue_story(story: Story, payload: str):
+    enqueue(
+        anchor_story,
+        {"story": story.pk, "birth_hash": story.user.birth_hash, "payload": payload},
+    )
+
+
+def attempt(job, what: str, submit):
+    """Runs submit() for job unless it's waiting for its next attempt.
+
+    Returns submit()'s result, or None if the job should be retried later."""
+    data = job.data
+    now = make_aware(datetime.now())
+    if data["next_attempt"] and now < datetime.fromisoformat(data["next_attempt"]):
+        return None
+    try:
+        return submit()
+    except Exception as exc:
+        data["attempts"] += 1
+        if data["attempts"] >= config.ANCHOR_MAX_ATTEMPTS:
+            raise Exception(
+                f"Giving up anchoring {what} after {data['attempts']} attempts: {exc}"
+            ) from exc
+        backoff = min(
+            config.ANCHOR_RETRY_BACKOFF * 2 ** (data["attempts"] - 1),
+            config.ANCHOR_RETRY_MAX_BACKOFF,
+        )
+        data["next_attempt"] = (now + timedelta(seconds=backoff)).isoformat()
+        job.logs = (job.logs or "") + f"{now.isoformat()} attempt failed: {exc}\n"
+        job.save(update_fields=["data", "logs"])
+        return None
+
+
+def run_claimed(job, func):
+    """Runs func(job) if job can be claimed, returns None otherwise so that it's
+    retried later."""
+    if not job.claim(timedelta(seconds=config.ANCHOR_CLAIM_TIMEOUT)):
+        return None
+    try:
+        return func(job)
+    finally:
+        job.release()
+
+
+def anchor_story(job):
+    """Job function: submit the story payload, returns True when done."""
+    return run_claimed(job, _anchor_story)
+
+
+def _anchor_story(job):
+    from sic import blockchain
+
+    data = job.data
+    if Story.objects.filter(pk=data["story"], story_hash__isnull=False).exists():
+        return True
+    story_hash = attempt(
+        job,
+        f"story {data['story']}",
+        lambda: blockchain.upload_story(
+            data["birth_hash"],
+            data["payload"],
+            idempotency_key=data["idempotency_key"],
+        ),
+    )
+    if story_hash is None:
+        return None
+    Story.objects.filter(pk=data["story"]).update(story_hash=story_hash)
+    return f"{make_aware(datetime.now()).isoformat()} anchored as {story_hash}\n"
+
+
+def vote_anchor_data(vote: Vote) -> str:
+    return json.dumps(
+        {
+            "type": "petmypet",
+            "birth_hash": vote.user.birth_hash,
+            "target_birth_hash": vote.story.user.birth_hash,
+            "story_hash": vote.story.story_hash,
+            "date": vote.created.isoformat(),
+        }
+    )
+
+
+@transaction.atomic
+def batch_votes(force=False):
+    """Collects pending votes into a VoteBatch if the oldest has waited for
+    VOTE_BATCH_WINDOW seconds or there are VOTE_BATCH_MAX_SIZE of them.
+
+    Votes on stories that aren't anchored yet wait for their story."""
+    pending = (
+        Vote.objects.filter(anchor_pending=True, story__story_hash__isnull=False)
+        .select_related("user", "story__user")
+        .order_by("created", "pk")
+    )
+    votes = list(pending[: config.VOTE_BATCH_MAX_SIZE])
+    if not votes:
+        return None
+    window = timedelta(seconds=config.VOTE_BATCH_WINDOW)
+    if (
+        not force
+        and len(votes) < config.VOTE_BATCH_MAX_SIZE
+        and make_aware(datetime.now()) - votes[0].created < window
+    ):
+        return None
+    anchor_data = [vote_anchor_data(vote) for vote in votes]
+    root, proofs = merkle.build([merkle.leaf_hash(d) for d in anchor_data])
+    batch = VoteBatch.objects.create(root=root, size=len(votes))
+    for i, vote in enumerate(votes):
+        vote.anchor_pending = False
+        vote.batch = batch
+        vote.anchor_data = anchor_data[i]
+        vote.leaf_index = i
+        vote.proof = proofs[i]
+    Vote.objects.bulk_update(
+        votes, ["anchor_pending", "batch", "anchor_data", "leaf_index", "proof"]
+    )
+    enqueue(anchor_vote_batch, {"batch": batch.pk})
+    return batch
+
+
+def anchor_vote_batch(job):
+    """Job function: submit a vote batch's Merkle root, returns True when done."""
+    return run_claimed(job, _anchor_vote_batch)
+
+
+def _anchor_vote_batch(job):
+    from sic import blockchain
+
+    data = job.data
+    batch = VoteBatch.objects.get(pk=data["batch"])
+    if batch.block_hash is not None:
+        return True
+    payload = json.dumps(
+        {"type": "petmypet_batch", "root": batch.root, "size": batch.size}
+    )
+    block_hash = attempt(
+        job,
+        f"vote batch {batch.pk}",
+        lambda: blockchain.upload_story(
+            blockchain.genesis_hash(),
+            payload,
+            idempotency_key=data["idempotency_key"],
+        ),
+    )
+    if block_hash is None:
+        return None
+    with transaction.atomic():
+        VoteBatch.objects.filter(pk=batch.pk).update(block_hash=block_hash)
+        Vote.objects.filter(batch=batch).update(vote_hash=block_hash)
+    return f"{make_aware(datetime.now()).isoformat()} anchored as {block_hash}\n"
+
+
+def run_pending():
+    batch_votes()
+    kinds = [JobKind.from_func(anchor_story), JobKind.from_func(anchor_vote_batch)]
+    for job in Job.objects.filter(kind__in=kinds, active=True, failed=False):
+        job.run()
+
+
+def worker():
+    while True:
+        wake.wait(timeout=config.ANCHOR_POLL_INTERVAL)
+        wake.clear()
+        try:
+            run_pending()
+        except Exception:
+            logger.exception("anchoring worker error")
@@ -17,9 +17,56 @@ class SicAppConfig(AppConfig):
     verbose_name = "PitPet"  # full human readable name
 
     S3_BUCKET = "pitpet-object-bucket"
+    # seconds presigned media URLs are valid for. They are cached until
+    # PRESIGNED_URL_MARGIN seconds before they expire.
+    PRESIGNED_URL_EXPIRY = 3660
+    PRESIGNED_URL_MARGIN = 300
+    # seconds to wait for connecting to and for replies from S3
+    S3_CONNECT_TIMEOUT = 5.0
+    S3_READ_TIMEOUT = 30.0
+    # media bigger than one part is uploaded in parts of this many bytes (at
+    # least 5 MiB), S3_UPLOAD_CONCURRENCY of them at a time. An upload holds at
+    # most part size * (concurrency + 1) bytes in memory.
+    S3_MULTIPART_PART_SIZE = 5 * 1024 * 1024
+    S3_UPLOAD_CONCURRENCY = 2
     API_ENDPOINT = (
-        "https://awolro67m3kvcwjrbax67toaj40cllpj.lambda-url.eu-central-1.on.aws/"
+        f"http://{settings.BLOCKCHAIN_STANDIN_ADDRESS}/"
+        if getattr(settings, "BLOCKCHAIN_STANDIN_ADDRESS", None)
+        else "https://awolro67m3kvcwjrbax67toaj40cllpj.lambda-url.eu-central-1.on.aws/"
     )
+    # seconds to wait for connecting to and for replies from API_ENDPOINT, and
+    # how many idle connections to it to keep alive
+    BLOCKCHAIN_CONNECT_TIMEOUT = 5.0
+    BLOCKCHAIN_READ_TIMEOUT = 30.0
+    BLOCKCHAIN_POOL_SIZE = 4
+    # look up many users' TTLs with one getTTLs request, if the API supports it
+    BLOCKCHAIN_BULK_TTL = False
+    # "bytes" sends story payloads as JSON arrays of byte values, "base64" as
+    # base64 strings, for APIs that accept it
+    BLOCKCHAIN_PAYLOAD_ENCODING = "bytes"
+    # gzip request bodies of at least this many bytes, None to never compress
+    BLOCKCHAIN_COMPRESS_MIN_SIZE: typing.Optional[int] = None
+    # calls to the blockchain API or S3 fail right away after this many
+    # consecutive failures, until a probe call after CIRCUIT_RESET_TIMEOUT
+    # seconds succeeds, see sic/resilience.py
+    CIRCUIT_FAILURE_THRESHOLD = 5
+    CIRCUIT_RESET_TIMEOUT = 30
+    # upper bounds in seconds of the external call latency histogram buckets
+    LATENCY_BUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+    # new stories are anchored in the background, see sic/anchoring.py. Failed
+    # attempts are retried after ANCHOR_RETRY_BACKOFF seconds, doubling up to
+    # ANCHOR_RETRY_MAX_BACKOFF.
+    ANCHOR_POLL_INTERVAL = 30
+    ANCHOR_MAX_ATTEMPTS = 10
+    ANCHOR_RETRY_BACKOFF = 5
+    ANCHOR_RETRY_MAX_BACKOFF = 60 * 60
+    # a job being anchored is claimed for this many seconds, so that other
+    # processes don't submit it too
+    ANCHOR_CLAIM_TIMEOUT = 10 * 60
+    # story votes are anchored in batches, as the root of a Merkle tree, when
+    # the oldest pending vote is this many seconds old or the batch is full
+    VOTE_BATCH_WINDOW = 60
+    VOTE_BATCH_MAX_SIZE = 1024
 
     subtitle = "is a community about pets and their lifetimes."
 
@@ -96,9 +143,49 @@ class SicAppConfig(AppConfig):
     FTS_DATABASE_FILENAME = "fts.db"
     FTS_COMMENTS_TABLE_NAME = "fts5_comments"
     FTS_STORIES_TABLE_NAME = "fts5_stories"
+    FTS_STORY_TITLES_TABLE_NAME = "fts5_story_titles"
 
     MENTION_TOKENIZER_NAME = "mention_tokenizer"
 
+    # markdown inputs longer than this are shown as escaped text
+    MARKDOWN_MAX_INPUT_LENGTH = 100_000
+    MARKDOWN_MAX_NESTING = 20
+    # markdown inputs longer than this are rendered in a process pool, with a
+    # time budget in seconds
+    MARKDOWN_RENDER_POOL_THRESHOLD = 10_000
+    MARKDOWN_RENDER_POOL_WORKERS = 2
+    MARKDOWN_RENDER_TIMEOUT = 2
+    # start the scheduling, anchoring and TTL threads in ready(). Markdown
+    # render worker processes turn this off, see sic/markdown_worker.py
+    BACKGROUND_THREADS = True
+
+    # seconds to cache rendered comment fragments for, see render_comments in
+    # sic/templatetags/comment.py. Relative timestamps may be this much out of date.
+    COMMENT_FRAGMENT_CACHE_TIMEOUT = 60
+
+    # seconds to cache rendered story list rows for, see sic/story_rows.py
+    STORY_ROW_CACHE_TIMEOUT = 60
+
+    # replies deeper than this are loaded on their own page, None for no limit
+    COMMENT_THREAD_MAX_DEPTH: typing.Optional[int] = 10
+
+    # render story list rows and comments with the Jinja2 templates in
+    # sic/jinja2/ instead of the Django ones, see sic/jinja.py
+    JINJA2_TEMPLATES = False
+
+    # user TTLs are served from the cache and refreshed in the background once
+    # older than TTL_FRESH_TIMEOUT seconds, see sic/ttl.py
+    TTL_FRESH_TIMEOUT = 60 * 3
+    TTL_STALE_TIMEOUT = 60 * 60 * 24 * 7
+    TTL_REFRESH_TIMEOUT = 60
+    TTL_REFRESH_BATCH_SIZE = 50
+
+    # send story pages while their comments are still being rendered
+    STREAM_STORY_PAGES = True
+
+    # maximum serialized length of a single session value, see sic/sessions.py
+    SESSION_MAX_VALUE_LENGTH = 4 * MARKDOWN_MAX_INPUT_LENGTH
+
     SEND_WEBMENTIONS = False
 
     FORMAT_QUOTED_MESSAGES = True
@@ -120,6 +207,12 @@ class SicAppConfig(AppConfig):
         weeks=1
     )
 
+    # trigram similarity (0.0 to 1.0) above which two titles are considered reposts
+    DUPLICATE_TITLE_SIMILARITY = 0.8
+
+    # fuzzy title search drops results less similar than this to the query
+    FUZZY_TITLE_MIN_SIMILARITY = 0.3
+
     ENABLE_KARMA = True
 
     VISIBLE_KARMA = False
@@ -195,11 +288,18 @@ class SicAppConfig(AppConfig):
         import sic.jobs
         import sic.flatpages
         import sic.s3
+        import sic.story_rows
         from sic.s3 import Session
 
+        self.aws_session = Session()
+        print(f"aws_session = {self.aws_session}")
+        if not self.BACKGROUND_THREADS:
+            return
+
         def sched_jobs():
             from sic.jobs import Job, JobKind
             from sic.blockchain import time_pass_func
+            from sic.sessions import clear_expired_sessions
             import sched
             import time
 
@@ -208,15 +308,16 @@ class SicAppConfig(AppConfig):
                     job.run()
 
             s = sched.scheduler(time.time, time.sleep)
-            kind = JobKind.from_func(time_pass_func)
-            try:
-                _job_obj, _ = Job.objects.get_or_create(
-                    kind=kind,
-                    periodic=True,
-                    data={},
-                )
-            except MultipleObjectsReturned:
-                pass
+            for func in [time_pass_func, clear_expired_sessions]:
+                kind = JobKind.from_func(func)
+                try:
+                    _job_obj, _ = Job.objects.get_or_create(
+                        kind=kind,
+                        periodic=True,
+                        data={},
+                    )
+                except MultipleObjectsReturned:
+                    pass
             while True:
                 s.enter(15 * 60, 1, exec_fn)
                 s.run(blocking=True)
@@ -224,8 +325,18 @@ class SicAppConfig(AppConfig):
         self.scheduling_thread = threading.Thread(target=sched_jobs, daemon=True)
         self.scheduling_thread.name = "scheduling_thread"
         self.scheduling_thread.start()
-        self.aws_session = Session()
-        print(f"aws_session = {self.aws_session}")
+
+        from sic.anchoring import worker
+
+        self.anchoring_thread = threading.Thread(target=worker, daemon=True)
+        self.anchoring_thread.name = "anchoring_thread"
+        self.anchoring_thread.start()
+
+        from sic.ttl import worker as ttl_worker
+
+        self.ttl_thread = threading.Thread(target=ttl_worker, daemon=True)
+        self.ttl_thread.name = "ttl_thread"
+        self.ttl_thread.start()
 
     @staticmethod
     @lru_cache(maxsize=None)
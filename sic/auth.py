@@ -35,6 +35,12 @@ from sic.flatpages import DocumentationFlatPage, CommunityFlatPage, ExternalLink
 
 CACHE_TIMEOUT = 60 * 30
 
+# (header_links, footer_links) cache keys by request.user.is_authenticated
+NAV_LINKS_CACHE_KEYS = {
+    False: ("header_links", "footer_links"),
+    True: ("header_links_authenticated", "footer_links_authenticated"),
+}
+
 
 class SicBackend(ModelBackend):
     def authenticate(
@@ -207,19 +213,16 @@ def user_save_receiver(sender, instance, created, raw, using, update_fields, **k
 @receiver(user_logged_in, sender=User)
 @receiver(user_logged_out, sender=User)
 def logout_login_hook(sender, request, user, **kwargs):
-    request.session["header_links"] = None
-    request.session["footer_links"] = None
-    cache.delete_many(["header_links", "footer_links"])
+    cache.delete_many([key for keys in NAV_LINKS_CACHE_KEYS.values() for key in keys])
 
 
 def auth_context(request):
     is_authenticated = request.user.is_authenticated
-    if is_authenticated:
-        header_links = request.session.get("header_links", default=None)
-        footer_links = request.session.get("footer_links", default=None)
-    else:
-        header_links = cache.get("header_links", default=None)
-        footer_links = cache.get("footer_links", default=None)
+    # Links differ only in registration_required flatpages, so they are cached
+    # per authentication state instead of per session.
+    header_links_key, footer_links_key = NAV_LINKS_CACHE_KEYS[is_authenticated]
+    header_links = cache.get(header_links_key, default=None)
+    footer_links = cache.get(footer_links_key, default=None)
 
     if header_links is None or footer_links is None:
         footer_links = ""
@@ -270,12 +273,8 @@ def auth_context(request):
                 else:
                     footer_links += f"""<li><a href="{l.flatpage_ptr.url}" rel="external nofollow">{l.link_name if l.link_name else l.flatpage_ptr.title}</a></li>"""
 
-        if is_authenticated:
-            request.session["header_links"] = header_links
-            request.session["footer_links"] = footer_links
-        else:
-            cache.set("header_links", header_links, timeout=CACHE_TIMEOUT)
-            cache.set("footer_links", footer_links, timeout=CACHE_TIMEOUT)
+        cache.set(header_links_key, header_links, timeout=CACHE_TIMEOUT)
+        cache.set(footer_links_key, footer_links, timeout=CACHE_TIMEOUT)
 
     if is_authenticated:
         return {
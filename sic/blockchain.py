@@ -1,65 +1,207 @@
+import gzip
 import json
+import logging
+import threading
+import time
+from base64 import b64encode
 from datetime import datetime, timedelta
-from urllib import request
+import urllib3
+from concurrent.futures import ThreadPoolExecutor
 from django.apps import apps
 from django.utils.timezone import make_aware
 
+from sic import resilience
+
 config = apps.get_app_config("sic")
 
+logger = logging.getLogger("sic")
 
-def send_request(json_data: bytes, expects_hash=True):
-    headers = {"Content-Type": "application/json"}
-    url = config.API_ENDPOINT
-    req = request.Request(url, json_data, headers)
-    with request.urlopen(req) as response:
-        resp = response.read().decode("utf-8")
-        print(f"got response {resp}")
-        # check if response looks like a hash
-        if not expects_hash:
-            return resp
-        is_hash = len(resp) == 64
-        try:
-            _v = int(resp, 16)
-        except ValueError:
-            is_hash = False
-        if not is_hash:
-            try:
-                is_hash = json.loads(is_hash)
-                if "error" in is_hash and "message" in is_hash:
-                    message = is_hash["message"]
-                    is_hash = f"Cloud blockchain replied with error: {message}"
-            except:
-                pass
-            # reply is an error string
-            raise Exception(resp)
+
+class BlockchainError(Exception):
+    """The API replied with an error status, the message is the reply body."""
+
+
+class Client:
+    """Blockchain API client which keeps connections to config.API_ENDPOINT
+    alive between calls, instead of a TCP and TLS handshake per request.
+
+    Calls go through the "blockchain" circuit breaker, and their latencies
+    are recorded per request type, see sic/resilience.py."""
+
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+        self.pool = urllib3.PoolManager(
+            num_pools=1,
+            maxsize=config.BLOCKCHAIN_POOL_SIZE,
+            block=False,
+            timeout=urllib3.Timeout(
+                connect=config.BLOCKCHAIN_CONNECT_TIMEOUT,
+                read=config.BLOCKCHAIN_READ_TIMEOUT,
+            ),
+            retries=False,
+        )
+
+    def post(self, json_data: bytes, kind: str = "") -> str:
+        start = time.perf_counter()
+        headers = {"Content-Type": "application/json"}
+        min_size = config.BLOCKCHAIN_COMPRESS_MIN_SIZE
+        if min_size is not None and len(json_data) >= min_size:
+            json_data = gzip.compress(json_data, compresslevel=6)
+            headers["Content-Encoding"] = "gzip"
+        # Only errors of the service count as failures for the circuit
+        # breaker, not replies rejecting the request.
+        with resilience.endpoint("blockchain").guard(kind):
+            response = self.pool.request(
+                "POST",
+                self.endpoint,
+                body=json_data,
+                headers=headers,
+            )
+            resp = response.data.decode("utf-8")
+            if response.status >= 500:
+                raise BlockchainError(resp)
+        logger.debug(
+            "blockchain %s took %.1fms", kind, (time.perf_counter() - start) * 1000
+        )
+        if response.status >= 400:
+            raise BlockchainError(resp)
         return resp
 
 
-def upload_story(birth_hash: str, data: str):
-    bindata = data.encode("utf-8")
-    json_data = {
-        "type": "addBlock",
-        "birth_hash": birth_hash,
-        "data": [byte for byte in bindata],
-    }
-    return send_request(json.dumps(json_data).encode("utf-8"))
+_client = None
+_client_lock = threading.Lock()
+
+
+def client() -> Client:
+    """The shared Client, created on first use."""
+    global _client
+    with _client_lock:
+        if _client is None or _client.endpoint != config.API_ENDPOINT:
+            _client = Client(config.API_ENDPOINT)
+        return _client
+
+
+def send_request(json_data: bytes, expects_hash=True, kind: str = ""):
+    resp = client().post(json_data, kind)
+    logger.debug("blockchain replied with %s", resp)
+    # check if response looks like a hash
+    if not expects_hash:
+        return resp
+    is_hash = len(resp) == 64
+    try:
+        _v = int(resp, 16)
+    except ValueError:
+        is_hash = False
+    if not is_hash:
+        try:
+            is_hash = json.loads(is_hash)
+            if "error" in is_hash and "message" in is_hash:
+                message = is_hash["message"]
+                is_hash = f"Cloud blockchain replied with error: {message}"
+        except:
+            pass
+        # reply is an error string
+        raise Exception(resp)
+    return resp
+
+
+def encode_payloads(json_data: dict, **payloads: str) -> dict:
+    """Adds the payloads to json_data, as arrays of byte values or as base64
+    strings depending on config.BLOCKCHAIN_PAYLOAD_ENCODING."""
+    if config.BLOCKCHAIN_PAYLOAD_ENCODING == "base64":
+        json_data["encoding"] = "base64"
+        for key, value in payloads.items():
+            json_data[key] = b64encode(value.encode("utf-8")).decode("ascii")
+    else:
+        for key, value in payloads.items():
+            json_data[key] = list(value.encode("utf-8"))
+    return json_data
+
+
+def upload_story(birth_hash: str, data: str, idempotency_key=None):
+    json_data = encode_payloads(
+        {"type": "addBlock", "birth_hash": birth_hash},
+        data=data,
+    )
+    if idempotency_key:
+        # retries with the same key return the hash of the first block
+        json_data["idempotency_key"] = idempotency_key
+    return send_request(json.dumps(json_data).encode("utf-8"), kind="addBlock")
 
 
 def spawn_story(birth_data, data):
-    bindata = data.encode("utf-8")
-    binbirth_data = birth_data.encode("utf-8")
-    json_data = {
-        "type": "spawnBlock",
-        "birth_data": [byte for byte in binbirth_data],
-        "data": [byte for byte in bindata],
-    }
-    return send_request(json.dumps(json_data).encode("utf-8"))
+    json_data = encode_payloads(
+        {"type": "spawnBlock"},
+        birth_data=birth_data,
+        data=data,
+    )
+    return send_request(json.dumps(json_data).encode("utf-8"), kind="spawnBlock")
 
 
 def get_ttl(user):
-    birth_hash = user.birth_hash
+    return get_ttl_of(user.birth_hash)
+
+
+def get_ttl_of(birth_hash: str):
     json_data = {"type": "getTTL", "birth_hash": birth_hash}
-    return send_request(json.dumps(json_data).encode("utf-8"), expects_hash=False)
+    return send_request(
+        json.dumps(json_data).encode("utf-8"), expects_hash=False, kind="getTTL"
+    )
+
+
+def get_ttls(birth_hashes) -> dict:
+    """getTTL replies for many birth hashes, with a single getTTLs request if
+    config.BLOCKCHAIN_BULK_TTL is set or else concurrently over the client's
+    connection pool. Failed lookups map to the exception raised."""
+    birth_hashes = set(birth_hashes)
+    # users who haven't started a story have an empty birth hash
+    not_started = BlockchainError("No story has been started yet.")
+    ret = {h: not_started for h in birth_hashes if not h}
+    birth_hashes = [h for h in birth_hashes if h]
+    if not birth_hashes:
+        return ret
+    if config.BLOCKCHAIN_BULK_TTL:
+        json_data = {"type": "getTTLs", "birth_hashes": birth_hashes}
+        try:
+            replies = json.loads(
+                send_request(
+                    json.dumps(json_data).encode("utf-8"),
+                    expects_hash=False,
+                    kind="getTTLs",
+                )
+            )
+        except Exception as exc:
+            replies = {}
+            missing = exc
+        else:
+            missing = BlockchainError("No reply for birth hash.")
+        ret.update({h: replies.get(h, missing) for h in birth_hashes})
+        return ret
+
+    def one(birth_hash):
+        try:
+            return get_ttl_of(birth_hash)
+        except Exception as exc:
+            return exc
+
+    with ThreadPoolExecutor(max_workers=config.BLOCKCHAIN_POOL_SIZE) as executor:
+        ret.update(zip(birth_hashes, executor.map(one, birth_hashes)))
+    return ret
+
+
+_genesis_hash = None
+
+
+def genesis_hash() -> str:
+    global _genesis_hash
+    if _genesis_hash is None:
+        req = {
+            "type": "printGenesis",
+        }
+        _genesis_hash = send_request(
+            json.dumps(req).encode("utf-8"), kind="printGenesis"
+        )
+    return _genesis_hash
 
 
 def time_pass_func(job):
@@ -75,8 +217,4 @@ def time_pass_func(job):
         diff = now - last_ts
         if diff < timedelta(hours=12):
             return
-    req = {
-        "type": "printGenesis",
-    }
-    genesis_hash = send_request(json.dumps(req).encode("utf-8"))
-    return upload_story(genesis_hash, now.isoformat())
+    return upload_story(genesis_hash(), now.isoformat())
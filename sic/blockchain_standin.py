@@ -0,0 +1,185 @@
+"""A local stand-in for the blockchain API, for tests, load tests and
+benchmarks that shouldn't depend on the remote endpoint.
+
+It implements the requests sent by sic/blockchain.py (addBlock, spawnBlock,
+getTTL, getTTLs and printGenesis) over an in-memory chain, with configurable
+latency, error rate and concurrency. Payloads may be byte arrays or base64
+strings, and request bodies may be gzipped. Run it with the blockchain_standin
+management command and set BLOCKCHAIN_STANDIN_ADDRESS in the settings to
+point the app at it.
+
+Blocks are identified by the sha256 of their parent's hash and their data.
+A birth hash stays alive for `lifetime` seconds after its last block, and
+getTTL replies with the remaining fraction of that lifetime.
+"""
+
+import gzip
+import hashlib
+import json
+import random
+import threading
+import time
+from base64 import b64decode
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class RequestError(Exception):
+    pass
+
+
+class Chain:
+    def __init__(self, lifetime: float):
+        self.lifetime = lifetime
+        self.lock = threading.Lock()
+        self.genesis = hashlib.sha256(b"pitpet genesis").hexdigest()
+        # block hash -> birth hash of the chain it belongs to
+        self.blocks = {self.genesis: self.genesis}
+        # birth hash -> time of its last block
+        self.last_block = {self.genesis: time.time()}
+        # idempotency key -> block hash
+        self.replies = {}
+
+    def add(self, parent: str, data: bytes, birth_hash=None) -> str:
+        block_hash = hashlib.sha256(
+            bytes.fromhex(parent) + data + str(len(self.blocks)).encode()
+        ).hexdigest()
+        birth_hash = birth_hash or block_hash
+        self.blocks[block_hash] = birth_hash
+        self.last_block[birth_hash] = time.time()
+        return block_hash
+
+    def add_block(self, birth_hash: str, data: bytes, idempotency_key=None) -> str:
+        with self.lock:
+            if idempotency_key in self.replies:
+                return self.replies[idempotency_key]
+            if birth_hash not in self.last_block:
+                raise RequestError("Unknown birth hash.")
+            if self.ttl(birth_hash) == 0:
+                raise RequestError("This story has ended.")
+            block_hash = self.add(birth_hash, data, birth_hash)
+            if idempotency_key:
+                self.replies[idempotency_key] = block_hash
+            return block_hash
+
+    def spawn_block(self, birth_data: bytes, data: bytes) -> str:
+        with self.lock:
+            parent = hashlib.sha256(birth_data).hexdigest()
+            return self.add(parent, data)
+
+    def ttl(self, birth_hash: str) -> float:
+        if birth_hash == self.genesis:
+            return 1.0
+        age = time.time() - self.last_block[birth_hash]
+        return max(0.0, 1.0 - age / self.lifetime)
+
+
+def payload(req: dict, key: str) -> bytes:
+    if req.get("encoding") == "base64":
+        return b64decode(req[key], validate=True)
+    return bytes(req[key])
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # replies are written as two segments, headers then body
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def reply(self, status: int, body):
+        if not isinstance(body, str):
+            body = json.dumps(body)
+        body = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def error(self, status: int, message: str):
+        self.reply(status, {"error": True, "message": message})
+
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.headers.get("Content-Encoding") == "gzip":
+            try:
+                body = gzip.decompress(body)
+            except OSError:
+                return self.error(400, "Invalid gzip body.")
+        with server.slots:
+            latency = max(0.0, server.rng.gauss(server.latency, server.jitter))
+            time.sleep(latency)
+            if server.rng.random() < server.error_rate:
+                return self.error(503, "Service unavailable.")
+            try:
+                req = json.loads(body)
+                self.handle_request(req["type"], req)
+            except RequestError as exc:
+                self.error(400, str(exc))
+            except (ValueError, KeyError, TypeError):
+                self.error(400, "Invalid request.")
+
+    def handle_request(self, kind, req):
+        chain = self.server.chain
+        if kind == "printGenesis":
+            self.reply(200, chain.genesis)
+        elif kind == "addBlock":
+            self.reply(
+                200,
+                chain.add_block(
+                    req["birth_hash"],
+                    payload(req, "data"),
+                    req.get("idempotency_key"),
+                ),
+            )
+        elif kind == "spawnBlock":
+            self.reply(
+                200, chain.spawn_block(payload(req, "birth_data"), payload(req, "data"))
+            )
+        elif kind == "getTTL":
+            if req["birth_hash"] not in chain.last_block:
+                raise RequestError("Unknown birth hash.")
+            self.reply(200, str(chain.ttl(req["birth_hash"])))
+        elif kind == "getTTLs":
+            replies = {}
+            for birth_hash in req["birth_hashes"]:
+                if birth_hash in chain.last_block:
+                    replies[birth_hash] = str(chain.ttl(birth_hash))
+                else:
+                    replies[birth_hash] = json.dumps(
+                        {"error": True, "message": "Unknown birth hash."}
+                    )
+            self.reply(200, replies)
+        else:
+            raise RequestError(f"Unknown request type {kind}.")
+
+
+def make_server(
+    address=("127.0.0.1", 8100),
+    latency: float = 0.0,
+    jitter: float = 0.0,
+    error_rate: float = 0.0,
+    concurrency: int = 16,
+    lifetime: float = 60 * 60 * 24 * 30,
+    seed=None,
+    verbose: bool = False,
+) -> ThreadingHTTPServer:
+    """Returns the stand-in server, call serve_forever() to run it.
+
+    latency and jitter are the mean and standard deviation of the delay
+    added to each request in seconds, error_rate the fraction of requests
+    answered with a 503 error, and concurrency the number of requests handled
+    at once, which caps throughput at concurrency / latency."""
+    server = ThreadingHTTPServer(address, Handler)
+    server.daemon_threads = True
+    server.chain = Chain(lifetime)
+    server.latency = latency
+    server.jitter = jitter
+    server.error_rate = error_rate
+    server.slots = threading.BoundedSemaphore(concurrency)
+    server.rng = random.Random(seed)
+    server.verbose = verbose
+    return server
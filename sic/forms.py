@@ -42,6 +42,7 @@ class SubmitStoryForm(forms.Form):
     )
     content = forms.CharField(
         required=False,
+        max_length=config.MARKDOWN_MAX_INPUT_LENGTH,
         widget=forms.Textarea({"rows": 5, "cols": 15, "placeholder": ""}),
         help_text=None,
     )
@@ -98,6 +99,7 @@ class SubmitCommentForm(forms.Form):
             "{comment}", comment=config.model_verbose_names("comment", False)
         ),
         min_length=1,
+        max_length=config.MARKDOWN_MAX_INPUT_LENGTH,
         widget=forms.Textarea({"rows": 6, "cols": 15, "placeholder": ""}),
     )
 
@@ -130,6 +132,7 @@ class EditReplyForm(forms.Form):
         required=True,
         label="Edit",
         min_length=1,
+        max_length=config.MARKDOWN_MAX_INPUT_LENGTH,
         widget=forms.Textarea({"rows": 6, "cols": 15, "placeholder": ""}),
     )
     edit_reason = forms.CharField(
@@ -619,6 +622,14 @@ class SearchCommentsForm(forms.Form):
         initial="both",
         widget=forms.RadioSelect,
     )
+    fuzzy = forms.BooleanField(
+        required=False,
+        label="fuzzy title match",
+        help_text=format_lazy(
+            "Match {story} titles by similarity instead of full text, tolerating typos and partial words.",
+            story=config.model_verbose_names("story", False),
+        ),
+    )
     order_by = forms.ChoiceField(
         required=True,
         label="order by",
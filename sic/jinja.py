@@ -0,0 +1,127 @@
+"""Jinja2 environment for the templates in sic/jinja2/.
+
+The most frequently rendered fragments, story list rows and comments, have
+Jinja2 versions which are used instead of the Django templates when
+config.JINJA2_TEMPLATES is set. The globals and filters here are the
+equivalents of the Django tags and filters those templates use.
+"""
+
+from django.apps import apps
+from django.core.exceptions import ObjectDoesNotExist
+from django.contrib.humanize.templatetags.humanize import naturaltime
+from django.template import defaultfilters, engines
+from django.template.backends.utils import csrf_input_lazy, csrf_token_lazy
+from django.urls import reverse
+from django.utils import formats
+from django.utils.html import strip_spaces_between_tags
+from django.utils.safestring import mark_safe
+from django.utils.timezone import template_localtime
+from jinja2 import Environment
+from markupsafe import Markup
+
+from sic import sessions
+from sic.viewer_state import ViewerState
+
+config = apps.get_app_config("sic")
+
+
+def get_template(name: str):
+    """Returns the compiled jinja2.Template, skipping the backend wrapper's
+    per render context copying."""
+    return engines["jinja2"].get_template(name).template
+
+
+def template_context(context, request) -> dict:
+    """Flattens a Django template context for rendering Jinja2 fragments."""
+    ret = context.flatten()
+    ret.update(
+        {
+            "request": request,
+            "csrf_input": csrf_input_lazy(request),
+            "csrf_token": csrf_token_lazy(request),
+        }
+    )
+    return ret
+
+
+def url(viewname, *args):
+    return reverse(viewname, args=args or None)
+
+
+def url_with_next(viewname, *args, request):
+    from sic.templatetags.utils import with_next
+
+    return with_next(url(viewname, *args), request)
+
+
+def model_verbose_name(model_name: str, plural: bool, capitalize: bool = False):
+    from sic.templatetags.utils import model_verbose_name
+
+    return model_verbose_name(model_name, plural, capitalize)
+
+
+def get_comment_preview(request, comment_pk: int):
+    """Returns (input, html) of the comment preview or ("", None)."""
+    preview = sessions.get_comment_preview(request, str(comment_pk))
+    if preview is None:
+        return "", None
+    preview_input, html = preview
+    return preview_input, mark_safe(html)
+
+
+def last_log_entry(obj):
+    """obj.last_log_entry, or None if there isn't one: Django templates
+    silently resolve the DoesNotExist it raises to an empty value."""
+    try:
+        return obj.last_log_entry
+    except ObjectDoesNotExist:
+        return None
+
+
+def story_is_upvoted(request, story) -> bool:
+    user = request.user
+    return user.is_authenticated and ViewerState.of(user).story_is_upvoted(story)
+
+
+def comment_is_upvoted(request, comment) -> bool:
+    user = request.user
+    return user.is_authenticated and ViewerState.of(user).comment_is_upvoted(comment)
+
+
+def date(value, arg=None):
+    return defaultfilters.date(template_localtime(value), arg)
+
+
+def datetime(value):
+    """Renders a datetime like a Django template variable does."""
+    return formats.localize(template_localtime(value))
+
+
+def spaceless(value):
+    return Markup(strip_spaces_between_tags(str(value).strip()))
+
+
+def environment(**options):
+    env = Environment(**options)
+    env.globals.update(
+        {
+            "config": config,
+            "url": url,
+            "url_with_next": url_with_next,
+            "model_verbose_name": model_verbose_name,
+            "get_comment_preview": get_comment_preview,
+            "last_log_entry": last_log_entry,
+            "story_is_upvoted": story_is_upvoted,
+            "comment_is_upvoted": comment_is_upvoted,
+        }
+    )
+    env.filters.update(
+        {
+            "naturaltime": naturaltime,
+            "date": date,
+            "datetime": datetime,
+            "pluralize": defaultfilters.pluralize,
+            "spaceless": spaceless,
+        }
+    )
+    return env
@@ -53,10 +53,30 @@ class Job(models.Model):
     last_run = models.DateTimeField(default=None, null=True, blank=True)
     logs = models.TextField(null=True, blank=True)
     data = models.JSONField(null=True, blank=True)
+    claimed_until = models.DateTimeField(default=None, null=True, blank=True)
 
     def __str__(self):
         return f"{self.kind} {self.data}"
 
+    def claim(self, duration: timedelta) -> bool:
+        """Claims the job for duration unless another process or thread has an
+        unexpired claim. Returns True if the job was claimed. The job's data
+        and logs are reloaded, since another claimant may have changed them."""
+        now = make_aware(datetime.now())
+        claimed = (
+            Job.objects.filter(pk=self.pk)
+            .filter(
+                models.Q(claimed_until__isnull=True) | models.Q(claimed_until__lt=now)
+            )
+            .update(claimed_until=now + duration)
+        )
+        self.refresh_from_db(fields=["data", "logs", "claimed_until"])
+        return bool(claimed)
+
+    def release(self):
+        Job.objects.filter(pk=self.pk).update(claimed_until=None)
+        self.claimed_until = None
+
     def run(self):
         if not self.kind_id:
             return
@@ -0,0 +1,171 @@
+"""
+benchmark markdown rendering over a corpus of comment shapes, optionally failing
+when throughput regresses against a saved baseline
+"""
+
+import json
+import time
+import tracemalloc
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from sic.markdown import References, Textractor, render_pool, render_tokens
+
+config = apps.get_app_config("sic")
+
+
+def synthetic_references() -> References:
+    """The objects the corpus refers to, so that rendering doesn't depend on
+    the contents of the database."""
+    ret = References()
+    ret.users = {"bench_user"}
+    ret.tags = {"bench_tag": 1}
+    ret.stories = {1: "Benchmark story"}
+    return ret
+
+
+def corpus():
+    mention = "</u/bench_user>"
+    tag_link = "</t/bench_tag>"
+    story_link = "</s/1/>"
+
+    typical = f"""Thanks {mention}, this reminds me of {story_link}.
+
+I *really* liked the photos, especially the **second** one. More in {tag_link}:
+
+- one thing
+- another [thing](https://example.com/a/path?with=query)
+- a last thing with `inline code`
+
+> quoting the parent comment
+> over two lines
+
+See https://example.com for more.
+"""
+    return {
+        "small": f"Lovely picture {mention}!",
+        "typical": typical,
+        "heavy_links": " ".join([mention, tag_link, story_link] * 30),
+        "deep_quotes": "".join(
+            ">" * depth + f" level {depth}\n" for depth in range(1, 16)
+        ),
+        "long_code": "```\n"
+        + "".join(f"    line {i} = {i} * 2\n" for i in range(2000))
+        + "```\n",
+        "very_large": typical * 200,
+    }
+
+
+def measure(func, input_, min_time):
+    """Returns (calls per second, peak allocated bytes per call, queries per call)."""
+    tracemalloc.start()
+    with CaptureQueriesContext(connection) as queries:
+        func(input_)
+    _current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    calls = 0
+    start = time.perf_counter()
+    elapsed = 0.0
+    while elapsed < min_time:
+        func(input_)
+        calls += 1
+        elapsed = time.perf_counter() - start
+    return calls / elapsed, peak, len(queries)
+
+
+class Command(BaseCommand):
+    help = "Benchmark markdown rendering and plain text extraction throughput"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--min-time",
+            type=float,
+            default=1.0,
+            help="seconds to spend measuring each case",
+        )
+        parser.add_argument(
+            "--baseline",
+            type=str,
+            help="JSON file with previous results to compare against",
+        )
+        parser.add_argument(
+            "--save-baseline",
+            type=str,
+            help="write results as JSON to this file",
+        )
+        parser.add_argument(
+            "--max-regression",
+            type=float,
+            default=0.2,
+            help="fail if throughput drops by more than this fraction of the baseline",
+        )
+
+    def handle(self, *args, **kwargs):
+        min_time = kwargs["min_time"]
+        references = synthetic_references()
+        results = {}
+        pooled = {}
+        for name, input_ in corpus().items():
+            html, _text = render_tokens(input_, references)
+            for bench, func, arg in [
+                (
+                    "render_tokens",
+                    lambda input_: render_tokens(input_, references),
+                    input_,
+                ),
+                ("References.resolve", References.resolve, input_),
+                ("Textractor.extract", Textractor.extract, html),
+            ]:
+                per_sec, peak, queries = measure(func, arg, min_time)
+                results[f"{name}/{bench}"] = {
+                    "per_sec": per_sec,
+                    "peak_bytes": peak,
+                    "queries": queries,
+                }
+            if len(input_) > config.MARKDOWN_RENDER_POOL_THRESHOLD:
+                # comment_to_html sends these to render_pool: this measures the
+                # round trip to a worker, and tracemalloc doesn't see the
+                # worker's allocations
+                render_pool.render(input_, references)
+                per_sec, _peak, _queries = measure(
+                    lambda input_: render_pool.render(input_, references),
+                    input_,
+                    min_time,
+                )
+                pooled[f"{name}/render_pool.render"] = {"per_sec": per_sec}
+        for key, result in results.items():
+            self.stdout.write(
+                f"{key:<40} {result['per_sec']:>12.1f}/s {result['peak_bytes'] / 1024:>10.1f} KiB {result['queries']:>4} queries"
+            )
+        if pooled:
+            self.stdout.write("rendered in the process pool:")
+        for key, result in pooled.items():
+            self.stdout.write(f"{key:<40} {result['per_sec']:>12.1f}/s")
+        results.update(pooled)
+
+        if kwargs["save_baseline"]:
+            with open(kwargs["save_baseline"], "w") as f:
+                json.dump(results, f, indent=2)
+
+        if kwargs["baseline"]:
+            with open(kwargs["baseline"], "r") as f:
+                baseline = json.load(f)
+            regressions = []
+            for key, result in results.items():
+                if key not in baseline:
+                    continue
+                floor = baseline[key]["per_sec"] * (1.0 - kwargs["max_regression"])
+                if result["per_sec"] < floor:
+                    regressions.append(
+                        f"{key}: {result['per_sec']:.1f}/s, baseline {baseline[key]['per_sec']:.1f}/s"
+                    )
+                if result.get("queries", 0) > baseline[key].get("queries", 0):
+                    regressions.append(
+                        f"{key}: {result['queries']} queries, baseline {baseline[key]['queries']}"
+                    )
+            if regressions:
+                raise CommandError(
+                    "Markdown rendering regressed:\n" + "\n".join(regressions)
+                )
@@ -0,0 +1,76 @@
+"""
+run a local stand-in for the blockchain API, see sic/blockchain_standin.py
+"""
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from sic.blockchain_standin import make_server
+
+
+class Command(BaseCommand):
+    help = "Run a local stand-in for the blockchain API"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "address",
+            nargs="?",
+            default=getattr(settings, "BLOCKCHAIN_STANDIN_ADDRESS", None)
+            or "127.0.0.1:8100",
+            help="host:port to listen on, defaults to BLOCKCHAIN_STANDIN_ADDRESS",
+        )
+        parser.add_argument(
+            "--latency",
+            type=float,
+            default=0.0,
+            help="mean delay added to each request, in milliseconds",
+        )
+        parser.add_argument(
+            "--jitter",
+            type=float,
+            default=0.0,
+            help="standard deviation of the delay, in milliseconds",
+        )
+        parser.add_argument(
+            "--error-rate",
+            type=float,
+            default=0.0,
+            help="fraction of requests to fail with a 503 error",
+        )
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=16,
+            help="requests handled at once, others wait for a free slot",
+        )
+        parser.add_argument(
+            "--lifetime",
+            type=float,
+            default=30.0,
+            help="days a story stays alive after its last block",
+        )
+        parser.add_argument(
+            "--seed", type=int, default=None, help="seed for latencies and errors"
+        )
+        parser.add_argument("--verbose", action="store_true", default=False)
+
+    def handle(self, *args, **kwargs):
+        host, _, port = kwargs["address"].rpartition(":")
+        server = make_server(
+            address=(host or "127.0.0.1", int(port)),
+            latency=kwargs["latency"] / 1000,
+            jitter=kwargs["jitter"] / 1000,
+            error_rate=kwargs["error_rate"],
+            concurrency=kwargs["concurrency"],
+            lifetime=kwargs["lifetime"] * 24 * 60 * 60,
+            seed=kwargs["seed"],
+            verbose=kwargs["verbose"],
+        )
+        self.stdout.write(
+            f"Blockchain API stand-in listening on http://{kwargs['address']}/, genesis {server.chain.genesis}"
+        )
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
@@ -4,7 +4,7 @@ from django.apps import apps
 
 config = apps.get_app_config("sic")
 from sic.models import Comment, Story
-from sic.search import fts5_setup, index_comment, index_story
+from sic.search import clear_story_index, fts5_setup, index_comment, index_story
 
 
 class Command(BaseCommand):
@@ -19,6 +19,9 @@ class Command(BaseCommand):
         comments = Comment.objects.filter(deleted=False)
         for c in comments:
             index_comment(c)
+        # stories indexed before their old tokens were deleted on update may
+        # still match their previous title and content
+        clear_story_index()
         stories = Story.objects.filter(active=True)
         for s in stories:
             index_story(s)
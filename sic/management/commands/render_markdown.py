@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from sic.models import Comment, Story
+
+
+class Command(BaseCommand):
+    help = "(Re)Render stored HTML of comments and stories whose markdown source or renderer version changed"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--force",
+            action="store_true",
+            help="Re-render everything, for example after referenced users or tags changed",
+        )
+
+    @transaction.atomic
+    def handle(self, *args, **kwargs):
+        force = kwargs["force"]
+        for model in [Comment, Story]:
+            stale = []
+            for obj in model.objects.all().iterator():
+                if obj.render_markdown(force=force):
+                    stale.append(obj)
+            model.objects.bulk_update(stale, model.RENDERED_FIELDS, batch_size=500)
+            self.stdout.write(
+                f"Rendered {len(stale)} {model._meta.verbose_name_plural}."
+            )
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+from sic.models import Vote
+
+
+class Command(BaseCommand):
+    help = "Check batched votes' inclusion proofs against their batch's Merkle root"
+
+    def add_arguments(self, parser):
+        parser.add_argument("vote_pks", nargs="*", type=int)
+
+    def handle(self, *args, **kwargs):
+        votes = Vote.objects.filter(batch__isnull=False).select_related("batch")
+        if kwargs["vote_pks"]:
+            votes = votes.filter(pk__in=kwargs["vote_pks"])
+        failed = 0
+        for vote in votes:
+            if not vote.verify():
+                failed += 1
+                self.stderr.write(
+                    f"vote {vote.pk}: proof does not match batch {vote.batch}"
+                )
+            elif vote.batch.block_hash is None:
+                self.stdout.write(
+                    f"vote {vote.pk}: ok, batch {vote.batch_id} not anchored yet"
+                )
+            else:
+                self.stdout.write(
+                    f"vote {vote.pk}: ok, anchored in {vote.batch.block_hash}"
+                )
+        if failed:
+            raise CommandError(f"{failed} votes failed verification.")
@@ -1,9 +1,20 @@
 from html.parser import HTMLParser
+import atexit
+import hashlib
+import logging
+import multiprocessing
+import multiprocessing.pool
 import re
+import threading
+import time
 from markdown_it import MarkdownIt
 from markdown_it.rules_inline import StateInline
+from django.utils.html import format_html
 from django.utils.safestring import mark_safe
-from django.urls import reverse, resolve
+from django.urls import reverse
+from django.apps import apps
+
+config = apps.get_app_config("sic")
 
 
 def link_render(self, tokens, idx, options, env):
@@ -11,6 +22,10 @@ def link_render(self, tokens, idx, options, env):
 
 
 def make_link_rule(tag: str, url_fn, exists_fn, detect_fn=None):
+    """Inline rule for `</{tag}/objname>` links.
+
+    exists_fn and url_fn take the objname and the References of the rendered
+    source, so that rules don't query the database themselves."""
     if detect_fn is None:
         detect_fn = lambda t: len(f"</{tag}") if t.startswith(f"</{tag}/") else False
 
@@ -39,12 +54,16 @@ def make_link_rule(tag: str, url_fn, exists_fn, detect_fn=None):
                     break
 
             objname = state.src[start + 1 : pos]
-            exists = exists_fn(objname)
+            references = state.env.get("sic_references", None)
+            if references is None:
+                # Not rendered through comment_to_html, resolve this chunk only.
+                references = References.resolve(state.src)
+            exists = exists_fn(objname, references)
 
             if not exists:
                 return False
 
-            target_url = url_fn(objname)
+            target_url = url_fn(objname, references)
 
             token = state.push(f"{tag}_link_open", "a", 1)
             token.attrs = {}
@@ -72,59 +91,95 @@ def make_link_rule(tag: str, url_fn, exists_fn, detect_fn=None):
     return _func
 
 
-def user_exists(username):
-    from .models import User
+class References:
+    """Usernames, tag names and story ids referenced by a markdown source.
 
-    return User.objects.filter(username=username).exists()
+    Rendering is done in two phases: first every `</...>` reference in the
+    source is collected and resolved with one query per kind, then the inline
+    link rules look objects up here instead of querying for each link."""
 
+    REFERENCE_RE = re.compile(r"</([^<>]*)>")
+    STORY_URL_RE = re.compile(r"^s/(\d+)/(?:[^/]+/)?$")
 
-user_link = make_link_rule(
-    "u", lambda username: reverse("profile", kwargs={"name": username}), user_exists
-)
+    def __init__(self):
+        self.users = set()
+        # tag name -> tag pk
+        self.tags = {}
+        # story pk -> story title
+        self.stories = {}
 
+    @staticmethod
+    def story_pk(story_url: str):
+        match = References.STORY_URL_RE.match(story_url)
+        return int(match.group(1)) if match else None
 
-def tag_exists(name):
-    from .models import Tag
+    @staticmethod
+    def resolve(input_: str) -> "References":
+        from .models import User, Tag, Story
+
+        usernames, tag_names, story_pks = set(), set(), set()
+        for objname in References.REFERENCE_RE.findall(input_):
+            if objname.startswith("u/"):
+                usernames.add(objname[2:])
+            elif objname.startswith("t/"):
+                tag_names.add(objname[2:])
+            else:
+                story_pk = References.story_pk(objname)
+                if story_pk is not None:
+                    story_pks.add(story_pk)
+
+        ret = References()
+        if usernames:
+            ret.users = set(
+                User.objects.filter(username__in=usernames).values_list(
+                    "username", flat=True
+                )
+            )
+        if tag_names:
+            ret.tags = dict(
+                Tag.objects.filter(name__in=tag_names).values_list("name", "pk")
+            )
+        if story_pks:
+            ret.stories = dict(
+                Story.objects.filter(pk__in=story_pks).values_list("pk", "title")
+            )
+        return ret
 
-    tag = Tag.objects.filter(name=name)
-    if not tag.exists():
-        return False
-    return tag.first().name
 
+user_link = make_link_rule(
+    "u",
+    lambda username, _references: reverse("profile", kwargs={"name": username}),
+    lambda username, references: username in references.users,
+)
 
-def tag_url(name):
-    from .models import Tag
 
-    return Tag.objects.filter(name=name).first().get_absolute_url()
+def tag_url(name, references):
+    from .models import Tag
 
+    return Tag(pk=references.tags[name], name=name).get_absolute_url()
 
-tag_link = make_link_rule("t", tag_url, tag_exists)
 
+tag_link = make_link_rule(
+    "t", tag_url, lambda name, references: name in references.tags and name
+)
 
-def story_exists(story_url):
-    from .models import Story
-    from .views import stories
 
-    try:
-        func, args, kwargs = resolve(f"/{story_url}")
-        if func == stories.story:
-            story_obj = Story.objects.get(pk=kwargs["story_pk"])
-            return story_obj.title
-        return False
-    except Exception:
+def story_exists(story_url, references):
+    story_pk = References.story_pk(story_url)
+    if story_pk is None:
         return False
+    return references.stories.get(story_pk, False)
 
 
 story_link = make_link_rule(
     "story_tag",
-    lambda story_url: f"/{story_url}",
+    lambda story_url, _references: f"/{story_url}",
     story_exists,
     detect_fn=lambda t: 1 if t.startswith("</") else False,
 )
-# tag_link = make_link_rule("t", lambda name: f"/t/{name}", tag_exists)
 
 MarkdownRenderer = (
-    MarkdownIt("gfm-like", {"html": False})
+    MarkdownIt("gfm-like", {"html": False, "maxNesting": config.MARKDOWN_MAX_NESTING})
     .enable(["linkify"])
     .use(user_link)
     .use(tag_link)
@@ -132,8 +187,218 @@ MarkdownRenderer = (
 )
 
 
+class PlainTextRenderer:
+    """Renders a markdown-it token stream as plain text.
+
+    Produces the text content of the HTML rendering of the same tokens, as
+    Textractor would extract it, without having to render and parse the HTML:
+    the text between two tags is a run whose whitespace is collapsed, and
+    block tags are followed by the same newlines RendererHTML writes."""
+
+    whitespace = re.compile(r"\s{2,}")
+
+    def __init__(self):
+        self.output = []
+        self.run = []
+
+    def text(self, content: str):
+        self.run.append(content)
+
+    def tag(self):
+        if self.run:
+            run = "".join(self.run)
+            self.output.append(self.whitespace.sub(" ", run).replace("\ufeff", ""))
+            self.run = []
+
+    def render_token(self, tokens, idx):
+        """The text of RendererHTML.renderToken()."""
+        token = tokens[idx]
+        if token.hidden:
+            return
+        if token.block and token.nesting != -1 and idx and tokens[idx - 1].hidden:
+            self.text("\n")
+        self.tag()
+        if not token.block:
+            return
+        if token.nesting == 1 and idx + 1 < len(tokens):
+            next_token = tokens[idx + 1]
+            if next_token.type == "inline" or next_token.hidden:
+                return
+            if next_token.nesting == -1 and next_token.tag == token.tag:
+                return
+        self.text("\n")
+
+    def render_inline(self, tokens):
+        for idx, token in enumerate(tokens):
+            if token.type == "text":
+                self.text(token.content)
+            elif token.type == "softbreak":
+                self.text("\n")
+            elif token.type == "hardbreak":
+                self.tag()
+                self.text("\n")
+            elif token.type == "code_inline":
+                self.tag()
+                self.text(token.content)
+                self.tag()
+            else:
+                # image alt text is not part of the HTML text content
+                self.render_token(tokens, idx)
+
+    @staticmethod
+    def render(tokens) -> str:
+        renderer = PlainTextRenderer()
+        for idx, token in enumerate(tokens):
+            if token.type == "inline":
+                renderer.render_inline(token.children or [])
+            elif token.type in ("fence", "code_block"):
+                renderer.tag()
+                renderer.text(token.content)
+                renderer.tag()
+                renderer.text("\n")
+            else:
+                renderer.render_token(tokens, idx)
+        renderer.tag()
+        return "".join(renderer.output)
+
+
+def render_tokens(input_: str, references: References):
+    """Render markdown to HTML and plain text with a single parse."""
+    # markdown-it keeps link reference definitions in env["references"]
+    env = {"sic_references": references}
+    tokens = MarkdownRenderer.parse(input_, env)
+    html = MarkdownRenderer.renderer.render(tokens, MarkdownRenderer.options, env)
+    return html, PlainTextRenderer.render(tokens).strip()
+
+
+class RenderWorker:
+    """A render worker process, see sic/markdown_worker.py."""
+
+    def __init__(self, context):
+        from sic import markdown_worker
+
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=markdown_worker.main, args=(child_conn,), daemon=True
+        )
+        self.process.start()
+        child_conn.close()
+        try:
+            self.conn.recv()
+        except BaseException:
+            self.stop()
+            raise
+
+    def render(self, input_: str, references: References, timeout: float):
+        """Returns render_tokens()'s result, or the exception it raised."""
+        self.conn.send((input_, references))
+        if not self.conn.poll(timeout):
+            raise multiprocessing.TimeoutError
+        return self.conn.recv()
+
+    def stop(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+
+class RenderPool:
+    """Process pool for rendering large markdown inputs with a time budget.
+
+    Workers are started with forkserver (or spawn), since forking the server
+    process along with its threads isn't safe, and references are resolved in
+    the calling process so workers never touch the database. A stuck render
+    can't be cancelled, so on timeout its worker is killed and replaced, other
+    workers' renders carry on."""
+
+    def __init__(self):
+        methods = multiprocessing.get_all_start_methods()
+        self.context = multiprocessing.get_context(
+            "forkserver" if "forkserver" in methods else "spawn"
+        )
+        self.idle = []
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(config.MARKDOWN_RENDER_POOL_WORKERS)
+        atexit.register(self.reset)
+
+    def reset(self):
+        with self.lock:
+            workers, self.idle = self.idle, []
+        for worker in workers:
+            worker.stop()
+
+    def render(self, input_: str, references: References, timeout=None):
+        if timeout is None:
+            timeout = config.MARKDOWN_RENDER_TIMEOUT
+        # waiting for a free worker counts against the time budget, starting
+        # one doesn't
+        start = time.monotonic()
+        if not self.slots.acquire(timeout=timeout):
+            raise multiprocessing.TimeoutError
+        remaining = max(0, timeout - (time.monotonic() - start))
+        try:
+            with self.lock:
+                worker = self.idle.pop() if self.idle else None
+            if worker is None:
+                worker = RenderWorker(self.context)
+            try:
+                result = worker.render(input_, references, remaining)
+            except BaseException:
+                worker.stop()
+                raise
+            with self.lock:
+                self.idle.append(worker)
+        finally:
+            self.slots.release()
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+render_pool = RenderPool()
+
+
+def escaped_fallback(input_: str):
+    return format_html("<pre>{}</pre>", input_), input_, False
+
+
+def comment_to_html_and_text(input_):
+    """Render markdown to HTML and plain text, within size and time limits.
+
+    Returns (html, text, rendered). Inputs longer than
+    MARKDOWN_RENDER_POOL_THRESHOLD are rendered in render_pool; inputs that are
+    too long or take too long to render are shown as escaped text instead, and
+    rendered is False so the caller doesn't keep that as the final render."""
+    input_ = input_ or ""
+    if len(input_) > config.MARKDOWN_MAX_INPUT_LENGTH:
+        return escaped_fallback(input_)
+    references = References.resolve(input_)
+    if len(input_) <= config.MARKDOWN_RENDER_POOL_THRESHOLD:
+        html, text = render_tokens(input_, references)
+    else:
+        try:
+            html, text = render_pool.render(input_, references)
+        except multiprocessing.TimeoutError:
+            logging.warning(
+                "markdown render of %d characters timed out, showing escaped text",
+                len(input_),
+            )
+            return escaped_fallback(input_)
+    return mark_safe(html), text, True
+
+
 def comment_to_html(input_):
-    return mark_safe(MarkdownRenderer.render(input_))
+    return comment_to_html_and_text(input_)[0]
+
+
+# Rendered HTML is stored alongside markdown sources (see
+# sic.models.RenderedMarkdown). Bump this whenever the rendering output changes
+# so that `manage.py render_markdown` regenerates stale renders.
+RENDERER_VERSION = 3
+
+
+def render_hash(input_: str) -> str:
+    return hashlib.sha256(f"{RENDERER_VERSION}:{input_}".encode("utf-8")).hexdigest()
 
 
 # Extract plain text from HTML.
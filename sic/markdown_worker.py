@@ -0,0 +1,27 @@
+"""Entry point of the markdown render worker processes of
+sic.markdown.RenderPool.
+
+Workers aren't forked from the server process, which runs threads, but started
+with the forkserver (or spawn) method, so they set Django up themselves. This
+module must not use Django when it is imported."""
+
+
+def main(conn):
+    import django
+    from sic.apps import SicAppConfig
+
+    SicAppConfig.BACKGROUND_THREADS = False
+    django.setup()
+    from sic.markdown import render_tokens
+
+    conn.send("ready")
+    while True:
+        try:
+            input_, references = conn.recv()
+        except EOFError:
+            return
+        try:
+            result = render_tokens(input_, references)
+        except Exception as exc:
+            result = exc
+        conn.send(result)
@@ -0,0 +1,72 @@
+"""Merkle trees over votes, so that a batch of votes is anchored on the
+blockchain with a single block holding the root, see sic/anchoring.py.
+
+Leaves and inner nodes are hashed with different prefixes so that an inner
+node can't pass for a leaf. A node without a sibling is promoted to the next
+level as is, instead of being paired with a copy of itself.
+
+A proof is the list of sibling hashes from the leaf up to the root, each as
+[side, hexdigest] where side is "left" or "right" of the path.
+"""
+
+import hashlib
+import typing
+
+Proof = typing.List[typing.List[str]]
+
+
+def leaf_hash(data: str) -> str:
+    return hashlib.sha256(b"\x00" + data.encode("utf-8")).hexdigest()
+
+
+def node_hash(left: str, right: str) -> str:
+    return hashlib.sha256(
+        b"\x01" + bytes.fromhex(left) + bytes.fromhex(right)
+    ).hexdigest()
+
+
+def build(leaves: typing.List[str]) -> typing.Tuple[str, typing.List[Proof]]:
+    """Returns the root of the tree over the leaf hashes, and each leaf's proof."""
+    if not leaves:
+        raise ValueError("Cannot build a Merkle tree without leaves.")
+    proofs = [[] for _ in leaves]
+    # members[i] are the leaf indices below level[i]
+    level = list(leaves)
+    members = [[i] for i in range(len(leaves))]
+    while len(level) > 1:
+        next_level = []
+        next_members = []
+        for i in range(0, len(level) - 1, 2):
+            left, right = level[i], level[i + 1]
+            for leaf in members[i]:
+                proofs[leaf].append(["right", right])
+            for leaf in members[i + 1]:
+                proofs[leaf].append(["left", left])
+            next_level.append(node_hash(left, right))
+            next_members.append(members[i] + members[i + 1])
+        if len(level) % 2 == 1:
+            next_level.append(level[-1])
+            next_members.append(members[-1])
+        level = next_level
+        members = next_members
+    return level[0], proofs
+
+
+def root_from_proof(leaf: str, proof: Proof) -> str:
+    node = leaf
+    for side, sibling in proof:
+        if side == "left":
+            node = node_hash(sibling, node)
+        elif side == "right":
+            node = node_hash(node, sibling)
+        else:
+            raise ValueError(f"Invalid proof step side: {side}")
+    return node
+
+
+def verify(data: str, proof: Proof, root: str) -> bool:
+    """Checks that data is a leaf of the tree with the given root."""
+    try:
+        return root_from_proof(leaf_hash(data), proof) == root
+    except (TypeError, ValueError):
+        return False
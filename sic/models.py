@@ -1,5 +1,6 @@
 from urllib.parse import urlparse, unquote_plus, quote_plus
 from datetime import datetime, timedelta
+import hashlib
 import string
 import uuid
 import abc
@@ -9,6 +10,7 @@ import typing
 import json
 from django.db import models, connection, migrations
 from django.db.models import Q
+from django.db.models.functions import Length
 from django.db.models.expressions import RawSQL
 from django.contrib.auth.models import (
     BaseUserManager,
@@ -35,7 +37,7 @@ from django.apps import apps
 
 config = apps.get_app_config("sic")
 
-from .markdown import comment_to_html, Textractor
+from .markdown import comment_to_html, comment_to_html_and_text, render_hash
 
 url_decode_translation = str.maketrans(string.ascii_lowercase[:10], string.digits)
 url_encode_translation = str.maketrans(string.digits, string.ascii_lowercase[:10])
@@ -91,6 +93,58 @@ class Domain(models.Model):
         )
 
 
+class RenderedMarkdown(models.Model):
+    """Stores the rendered HTML and plain text of a markdown source field.
+
+    Renders are regenerated on save when the source or the renderer version
+    changes, so read paths don't have to run the markdown renderer."""
+
+    MARKDOWN_FIELD: str
+    RENDERED_FIELDS = ["rendered_html", "rendered_plain_text", "rendered_hash"]
+
+    rendered_html = models.TextField(null=True, blank=True, editable=False)
+    rendered_plain_text = models.TextField(null=True, blank=True, editable=False)
+    rendered_hash = models.CharField(
+        null=True, blank=True, editable=False, max_length=64
+    )
+
+    class Meta:
+        abstract = True
+
+    def render_markdown(self, force=False) -> bool:
+        """Render source if the stored render is stale. Returns True if it was.
+
+        If the renderer fell back to escaped text, rendered_hash is left unset
+        so that the source is rendered again later."""
+        source = getattr(self, self.MARKDOWN_FIELD) or ""
+        digest = render_hash(source)
+        if not force and digest == self.rendered_hash:
+            return False
+        html, text, rendered = comment_to_html_and_text(source)
+        self.rendered_html, self.rendered_plain_text = html, text
+        self.rendered_hash = digest if rendered else None
+        return True
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get("update_fields", None)
+        if update_fields is None or self.MARKDOWN_FIELD in update_fields:
+            if self.render_markdown() and update_fields is not None:
+                kwargs["update_fields"] = [*update_fields, *self.RENDERED_FIELDS]
+        super().save(*args, **kwargs)
+
+    def get_rendered_html(self) -> str:
+        if self.rendered_hash is None:
+            # Not rendered since before renders were stored, or the last render
+            # fell back to escaped text.
+            self.render_markdown()
+        return mark_safe(self.rendered_html)
+
+    def get_rendered_plain_text(self) -> str:
+        if self.rendered_hash is None:
+            self.render_markdown()
+        return self.rendered_plain_text
+
+
 class StoryKind(models.Model):
     id = models.AutoField(primary_key=True)
     name = models.CharField(null=False, blank=False, max_length=40, unique=True)
@@ -114,7 +168,9 @@ class StoryKind(models.Model):
         ordering = ["name"]
 
 
-class Story(models.Model):
+class Story(RenderedMarkdown):
+    MARKDOWN_FIELD = "content"
+
     class MediaKind(models.TextChoices):
         IMAGE = "IMG", "Image"
         VIDEO = "VID", "Video"
@@ -130,7 +186,8 @@ class Story(models.Model):
         default=MediaKind.IMAGE,
     )
     media_sha256 = models.CharField(null=True, blank=True, max_length=64)
-    story_hash = models.CharField(null=False, blank=False, max_length=64)
+    # None until the story is anchored, see sic/anchoring.py
+    story_hash = models.CharField(null=True, blank=True, max_length=64)
     content = models.TextField(null=True, blank=True)
     created = models.DateTimeField(auto_now_add=True)
     last_modified = models.DateTimeField(auto_now_add=True)
@@ -197,18 +254,38 @@ class Story(models.Model):
     def hotness(self):
         return config.post_ranking.story_hotness(self)
 
-    @cached_property
+    @property
     def content_to_html(self):
-        return comment_to_html(self.content)
+        return self.get_rendered_html()
 
-    @cached_property
+    @property
     def content_to_plain_text(self):
-        return Textractor.extract(self.content_to_html).strip()
+        return self.get_rendered_plain_text()
 
     @cached_property
     def active_comments(self):
         return self.comments.filter(deleted=False)
 
+    # The following are set for a whole page of stories by
+    # sic.story_rows.load_story_rows()
+
+    @cached_property
+    def active_comments_count(self) -> int:
+        return self.active_comments.count()
+
+    @cached_property
+    def tag_list(self):
+        return list(self.tags.all())
+
+    def comment_thread(self, max_depth=None):
+        """Active comments in display order, optionally down to max_depth."""
+        comments = self.active_comments.order_by("thread_path")
+        if max_depth is not None:
+            comments = comments.alias(thread_path_length=Length("thread_path")).filter(
+                thread_path_length__lte=max_depth * Comment.THREAD_PATH_SEGMENT_LENGTH
+            )
+        return comments
+
     # def save(self, *args, **kwargs):
     #    if self.url:
     #        netloc = urlparse(self.url).netloc
@@ -339,7 +416,9 @@ class Message(models.Model):
         )
 
 
-class Comment(models.Model):
+class Comment(RenderedMarkdown):
+    MARKDOWN_FIELD = "text"
+
     id = models.AutoField(primary_key=True)
     user = models.ForeignKey(
         "User", related_name="comments", on_delete=models.CASCADE, null=False
@@ -363,10 +442,52 @@ class Comment(models.Model):
     text = models.TextField(null=True, blank=False)
     karma = models.IntegerField(null=False, blank=True, default=0)
     message_id = models.TextField(null=True, blank=True)
+    # pks of the comment's ancestors and itself, see path_segment(). Sorting a
+    # story's comments by it gives display order, and each subthread is a range.
+    thread_path = models.TextField(null=True, blank=True, editable=False)
+
+    THREAD_PATH_SEGMENT_LENGTH = 11
+
+    class Meta:
+        indexes = [models.Index(fields=["story", "thread_path"])]
 
     def __str__(self):
         return f"{self.user} {self.created}"
 
+    @staticmethod
+    def path_segment(pk: int) -> str:
+        return f"{pk:010d}/"
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        if self.thread_path is None:
+            # The pk is only known after inserting.
+            parent_path = self.parent.thread_path if self.parent_id else None
+            self.thread_path = (parent_path or "") + Comment.path_segment(self.pk)
+            Comment.objects.filter(pk=self.pk).update(thread_path=self.thread_path)
+
+    @property
+    def thread_depth(self) -> int:
+        return len(self.thread_path) // Comment.THREAD_PATH_SEGMENT_LENGTH
+
+    def subthread(self, max_depth=None):
+        """Active comments in this comment's subthread, including itself, in
+        display order and optionally down to max_depth levels below it."""
+        # Every path with this prefix sorts before the prefix with its trailing
+        # "/" replaced by the next character.
+        comments = Comment.objects.filter(
+            story_id=self.story_id,
+            deleted=False,
+            thread_path__gte=self.thread_path,
+            thread_path__lt=self.thread_path[:-1] + chr(ord("/") + 1),
+        ).order_by("thread_path")
+        if max_depth is not None:
+            comments = comments.alias(thread_path_length=Length("thread_path")).filter(
+                thread_path_length__lte=(self.thread_depth + max_depth - 1)
+                * Comment.THREAD_PATH_SEGMENT_LENGTH
+            )
+        return comments
+
     @staticmethod
     @functools.lru_cache(None)
     def content_type():
@@ -384,6 +505,24 @@ class Comment(models.Model):
         return entry
 
     def get_absolute_url(self):
+        max_depth = config.COMMENT_THREAD_MAX_DEPTH
+        if (
+            max_depth is not None
+            and self.parent_id is not None
+            and self.thread_path is not None
+            and self.thread_depth > max_depth
+        ):
+            return (
+                reverse(
+                    "story_thread",
+                    kwargs={
+                        "story_pk": self.story_id,
+                        "slug": self.story.slugify,
+                        "comment_pk": self.parent_id,
+                    },
+                )
+                + f"#{self.slugify}"
+            )
         return self.story.get_absolute_url() + f"#{self.slugify}"
 
     @cached_property
@@ -398,13 +537,13 @@ class Comment(models.Model):
     def karma_(self):
         return self.votes.count()
 
-    @cached_property
+    @property
     def text_to_html(self):
-        return comment_to_html(self.text)
+        return self.get_rendered_html()
 
-    @cached_property
+    @property
     def text_to_plain_text(self):
-        return Textractor.extract(self.text_to_html).strip()
+        return self.get_rendered_plain_text()
 
     @property
     def get_message_id(self) -> str:
@@ -965,11 +1104,47 @@ class Vote(models.Model):
         Comment, related_name="votes", on_delete=models.CASCADE, null=True
     )
     created = models.DateTimeField(auto_now_add=True)
+    # hash of the block holding the vote, or of its batch's Merkle root
     vote_hash = models.CharField(null=True, blank=True, max_length=64)
+    # story votes waiting to be added to a VoteBatch, see sic/anchoring.py
+    anchor_pending = models.BooleanField(default=False, null=False)
+    batch = models.ForeignKey(
+        "VoteBatch",
+        related_name="votes",
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+    )
+    # the Merkle tree leaf is the hash of anchor_data, see sic/merkle.py
+    anchor_data = models.TextField(null=True, blank=True)
+    leaf_index = models.IntegerField(null=True, blank=True)
+    proof = models.JSONField(null=True, blank=True)
 
     class Meta:
         unique_together = ["user", "story", "comment"]
 
+    def verify(self) -> bool:
+        """Checks the vote's inclusion proof against its batch's root."""
+        from sic import merkle
+
+        if self.batch is None or self.anchor_data is None or self.proof is None:
+            return False
+        return merkle.verify(self.anchor_data, self.proof, self.batch.root)
+
+
+class VoteBatch(models.Model):
+    """Votes anchored together as a single block holding their Merkle root."""
+
+    id = models.AutoField(primary_key=True)
+    root = models.CharField(null=False, blank=False, max_length=64)
+    size = models.IntegerField(null=False)
+    created = models.DateTimeField(auto_now_add=True)
+    # hash of the block holding the root, None until it's anchored
+    block_hash = models.CharField(null=True, blank=True, max_length=64)
+
+    def __str__(self):
+        return f"{self.pk} {self.root}"
+
 
 class Moderation(models.Model):
     id = models.AutoField(primary_key=True)
@@ -1020,6 +1195,46 @@ class UserManager(BaseUserManager):
         return user
 
 
+class Avatar(models.Model):
+    """An avatar image, keyed by the sha256 digest of its contents."""
+
+    digest = models.CharField(primary_key=True, max_length=64, editable=False)
+    data = models.BinaryField(editable=False)
+    content_type = models.CharField(max_length=64, default="image/webp")
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.digest
+
+    @staticmethod
+    def store(data: bytes, content_type: str = "image/webp") -> "Avatar":
+        digest = hashlib.sha256(data).hexdigest()
+        obj, _ = Avatar.objects.get_or_create(
+            digest=digest, defaults={"data": data, "content_type": content_type}
+        )
+        return obj
+
+    def get_absolute_url(self):
+        return reverse("avatar", kwargs={"digest": self.digest})
+
+
+class MediaObject(models.Model):
+    """A media object in the S3 bucket, keyed by the sha256 digest of its
+    contents. refcount is the number of Story.media_sha256 and
+    User.picture_sha256 values referring to it, kept up to date by the
+    receivers in sic/s3.py (QuerySet.update() bypasses them). Objects no
+    longer used can be deleted from the bucket."""
+
+    digest = models.CharField(primary_key=True, max_length=64, editable=False)
+    # null for objects indexed from existing stories
+    size = models.BigIntegerField(null=True, blank=True, editable=False)
+    refcount = models.PositiveIntegerField(default=0)
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.digest
+
+
 class User(PermissionsMixin, AbstractBaseUser):
     id = models.AutoField(primary_key=True)
     username = models.CharField(null=True, blank=True, unique=True, max_length=100)
@@ -1032,10 +1247,21 @@ class User(PermissionsMixin, AbstractBaseUser):
     email_validated = models.BooleanField(default=False, null=False, blank=True)
     created = models.DateTimeField(auto_now_add=True)
     about = models.TextField(null=True, blank=True)
-    avatar = models.CharField(null=True, blank=True, editable=False, max_length=8196)
+    avatar = models.ForeignKey(
+        Avatar,
+        related_name="+",
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        editable=False,
+    )
     avatar_title = models.CharField(
         null=True, blank=True, editable=True, max_length=256
     )
+    # the media object of the picture the current story was started with
+    picture_sha256 = models.CharField(
+        null=True, blank=True, editable=False, max_length=64
+    )
     banned_by_user = models.OneToOneField(
         "User",
         related_name="banned_by",
@@ -1113,43 +1339,15 @@ class User(PermissionsMixin, AbstractBaseUser):
         return self.username if self.username else self.email
 
     def reset_ttl_cache(self):
-        key = f"{self}-ttl"
-        cache.delete(key)
+        from sic import ttl
+
+        ttl.refresh(self)
 
     def ttl(self):
-        from sic import blockchain
+        """(ttl, message) of the user's story, possibly stale, see sic/ttl.py"""
+        from sic import ttl
 
-        TIMEOUT = 60 * 3
-        key = f"{self}-ttl"
-        cached_val = cache.get(key)
-        if cached_val:
-            return cached_val
-
-        try:
-            ttl = blockchain.get_ttl(self)
-            print("network returned", ttl)
-            msg = ""
-            try:
-                d = json.loads(ttl)
-                if isinstance(d, dict) and "message" in d:
-                    msg = d["message"]
-                    ttl = 0
-            except json.JSONDecodeError:
-                pass
-            cache.set(key, (ttl, msg), timeout=TIMEOUT)
-            return ttl, msg
-        except Exception as exc:
-            print(exc)
-            print(f"user {self} got get_ttl error: {exc}")
-            msg = str(exc)
-            try:
-                msg = json.loads(msg)
-                if isinstance(msg, dict) and "message" in msg:
-                    msg = msg["message"]
-            except json.JSONDecodeError:
-                pass
-            cache.set(key, (0, msg), timeout=TIMEOUT)
-            return 0, msg
+        return ttl.get(self)
 
     def get_by_display_name(name: str) -> "User":
         try:
@@ -1173,6 +1371,13 @@ class User(PermissionsMixin, AbstractBaseUser):
             kwargs={"name": self.username if self.username else self.pk},
         )
 
+    @property
+    def avatar_url(self):
+        """URL of the avatar, without loading the image."""
+        if self.avatar_id is None:
+            return None
+        return reverse("avatar", kwargs={"digest": self.avatar_id})
+
     @cached_property
     def is_banned(self):
         return self.banned_by_user is not None
@@ -0,0 +1,163 @@
+"""Circuit breakers and latency histograms for calls to external services
+(the blockchain API and S3).
+
+Each service is an Endpoint, and calls to it are made in its guard():
+
+    with resilience.endpoint("s3").guard():
+        ...
+
+After CIRCUIT_FAILURE_THRESHOLD consecutive failures the endpoint's circuit
+opens and calls fail right away with CircuitOpenError, instead of tying up
+request threads waiting on a service that is down. After
+CIRCUIT_RESET_TIMEOUT seconds a single probe call is let through (half-open):
+if it succeeds the circuit closes, otherwise it opens again.
+
+Latencies are collected in histograms, exported in the Prometheus text
+format by the moderation_metrics view.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+from django.apps import apps
+
+config = apps.get_app_config("sic")
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = sorted(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.errors = 0
+        self.sum = 0.0
+
+    def observe(self, seconds: float, error: bool):
+        for i, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.errors += int(error)
+        self.sum += seconds
+
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+
+    def allow(self) -> bool:
+        """Whether a call may go through, a half-open circuit lets one call
+        through at a time."""
+        if self.state == self.OPEN:
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            self.state = self.HALF_OPEN
+        if self.state == self.HALF_OPEN:
+            if self.probing:
+                return False
+            self.probing = True
+        return True
+
+    def record(self, success: bool, probe: bool = False):
+        """Records a call's outcome. Once the circuit has opened, only the
+        half-open probe decides whether it closes: calls that started before
+        it opened don't count."""
+        if probe:
+            self.probing = False
+        elif self.state != self.CLOSED:
+            return
+        if success:
+            self.state = self.CLOSED
+            self.failures = 0
+            return
+        self.failures += 1
+        if probe or self.failures >= self.failure_threshold:
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+
+class Endpoint:
+    def __init__(self, name: str):
+        self.name = name
+        self.lock = threading.Lock()
+        self.breaker = CircuitBreaker(
+            config.CIRCUIT_FAILURE_THRESHOLD, config.CIRCUIT_RESET_TIMEOUT
+        )
+        self.histograms = {}
+
+    @contextmanager
+    def guard(self, operation: str = ""):
+        """Times the enclosed call, which fails if it raises."""
+        with self.lock:
+            if not self.breaker.allow():
+                raise CircuitOpenError(
+                    f"{self.name} is unavailable, try again in a moment."
+                )
+            probe = self.breaker.state == CircuitBreaker.HALF_OPEN
+        start = time.perf_counter()
+        error = True
+        try:
+            yield
+            error = False
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.breaker.record(not error, probe)
+                if operation not in self.histograms:
+                    self.histograms[operation] = Histogram(config.LATENCY_BUCKETS)
+                self.histograms[operation].observe(elapsed, error)
+
+
+_endpoints = {}
+_endpoints_lock = threading.Lock()
+
+
+def endpoint(name: str) -> Endpoint:
+    with _endpoints_lock:
+        if name not in _endpoints:
+            _endpoints[name] = Endpoint(name)
+        return _endpoints[name]
+
+
+def metrics() -> str:
+    """All endpoints' histograms and circuit states in the Prometheus text
+    exposition format."""
+    lines = ["# TYPE sic_external_call_seconds histogram"]
+    errors = ["# TYPE sic_external_call_errors_total counter"]
+    states = ["# TYPE sic_circuit_open gauge"]
+    with _endpoints_lock:
+        endpoints = list(_endpoints.values())
+    for ep in endpoints:
+        with ep.lock:
+            for operation, h in sorted(ep.histograms.items()):
+                labels = f'endpoint="{ep.name}",operation="{operation}"'
+                cumulative = 0
+                for bound, count in zip(h.buckets, h.counts):
+                    cumulative += count
+                    lines.append(
+                        f'sic_external_call_seconds_bucket{{{labels},le="{bound}"}} {cumulative}'
+                    )
+                lines.append(
+                    f'sic_external_call_seconds_bucket{{{labels},le="+Inf"}} {h.count}'
+                )
+                lines.append(f"sic_external_call_seconds_sum{{{labels}}} {h.sum}")
+                lines.append(f"sic_external_call_seconds_count{{{labels}}} {h.count}")
+                errors.append(f"sic_external_call_errors_total{{{labels}}} {h.errors}")
+            states.append(
+                f'sic_circuit_open{{endpoint="{ep.name}",state="{ep.breaker.state}"}} {int(ep.breaker.state != CircuitBreaker.CLOSED)}'
+            )
+    return "\n".join(lines + errors + states) + "\n"
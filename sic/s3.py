@@ -1,7 +1,10 @@
 import boto3
 import botocore
 import hashlib
+import logging
+import threading
 from base64 import b64decode, b64encode
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
 import typing
 from dataclasses import dataclass
@@ -9,9 +12,18 @@ from django.core.files.uploadedfile import UploadedFile
 
 from django.apps import apps
 from django.conf import settings
+from django.core.cache import cache
+from django.db.models import F
+from django.db.models.signals import post_delete, post_init, post_save
+from django.dispatch import receiver
+
+from sic import resilience
+from sic.models import MediaObject, Story, User
 
 config = apps.get_app_config("sic")
 
+logger = logging.getLogger("sic")
+
 
 class Session:
     def __init__(self, *args, **kwargs):
@@ -20,9 +32,22 @@ class Session:
             aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
             region_name=settings.AWS_REGION_NAME,
         )
+        self.config = botocore.config.Config(
+            connect_timeout=config.S3_CONNECT_TIMEOUT,
+            read_timeout=config.S3_READ_TIMEOUT,
+        )
+        self.client_lock = threading.Lock()
+        self._client = None
 
     def s3(self) -> boto3.resources.base.ServiceResource:
-        return self.session.resource("s3")
+        return self.session.resource("s3", config=self.config)
+
+    def client(self):
+        """A long-lived S3 client. Unlike resources, clients are thread safe."""
+        with self.client_lock:
+            if self._client is None:
+                self._client = self.session.client("s3", config=self.config)
+            return self._client
 
 
 @dataclass
@@ -38,29 +63,107 @@ class BucketObject:
         base64digest = b64encode(bytes.fromhex(digest)).decode("utf-8")
         return BucketObject(base64digest=base64digest, hexdigest=digest)
 
+    @property
+    def url_cache_key(self) -> str:
+        return f"presigned-url-{self.bucket_name}-{self.hexdigest}"
+
     def url(self) -> str:
-        resource = config.aws_session.s3()
-        retval = resource.meta.client.generate_presigned_url(
-            "get_object",
-            ExpiresIn=3660,
-            Params={"Bucket": self.bucket_name, "Key": self.hexdigest},
-        )
-        return retval
+        return BucketObject.urls([self])[0]
+
+    @staticmethod
+    def urls(objects: typing.Iterable["BucketObject"]) -> typing.List[str]:
+        """Presigned URLs of several objects.
+
+        URLs are cached until a little before they expire, and the missing ones
+        are signed together."""
+        objects = list(objects)
+        cached = cache.get_many([obj.url_cache_key for obj in objects])
+        missing = {}
+        for obj in objects:
+            if obj.url_cache_key not in cached and obj.url_cache_key not in missing:
+                missing[obj.url_cache_key] = obj.presign()
+        if missing:
+            cache.set_many(
+                missing,
+                timeout=config.PRESIGNED_URL_EXPIRY - config.PRESIGNED_URL_MARGIN,
+            )
+            cached.update(missing)
+        return [cached[obj.url_cache_key] for obj in objects]
+
+    def presign(self) -> str:
+        with resilience.endpoint("s3").guard("presign"):
+            return config.aws_session.client().generate_presigned_url(
+                "get_object",
+                ExpiresIn=config.PRESIGNED_URL_EXPIRY,
+                Params={"Bucket": self.bucket_name, "Key": self.hexdigest},
+            )
+
+
+def sha256_of(f: UploadedFile):
+    sha256 = hashlib.sha256()
+    for chunk in f.chunks():
+        sha256.update(chunk)
+    return sha256
+
+
+def read_parts(f: UploadedFile, part_size: int) -> typing.Iterator[bytes]:
+    f.seek(0)
+    while part := f.read(part_size):
+        yield part
 
 
 def upload_media(f: UploadedFile) -> BucketObject:
+    """Uploads f under its sha256 digest, unless the bucket already has it.
+
+    The file is read twice, once to hash it and once to upload it, in chunks:
+    Django spools big uploads to a temporary file, and they are never read
+    into memory whole. Files bigger than S3_MULTIPART_PART_SIZE are sent with
+    a multipart upload."""
     if f.size > 1024 * 1024 * 1024 * 5:
         raise Exception(f"Uploaded file is too big: {f.size} bytes")
-    s3 = config.aws_session.s3()
-    b = f.read()
-    sha256 = hashlib.sha256(b)
-    digest = sha256.digest()
-    hexdigest = sha256.hexdigest()
-
-    object_ = s3.Object(config.S3_BUCKET, hexdigest)
-    response = object_.put(
-        Body=b, ChecksumSHA256=b64encode(digest).decode("utf-8"), Key=hexdigest
+    digest = sha256_of(f).digest()
+    obj = BucketObject(
+        hexdigest=digest.hex(), base64digest=b64encode(digest).decode("utf-8")
     )
+    if not MediaObject.objects.filter(digest=obj.hexdigest).exists():
+        if bucket_has(obj, f.size):
+            logger.debug("s3 already has %s", obj.hexdigest)
+        elif f.size <= config.S3_MULTIPART_PART_SIZE:
+            put_object(f, obj)
+        else:
+            upload_multipart(f, obj)
+        MediaObject.objects.get_or_create(
+            digest=obj.hexdigest, defaults={"size": f.size}
+        )
+    return obj
+
+
+def bucket_has(obj: BucketObject, size: int) -> bool:
+    """Whether obj is in the bucket, for objects uploaded before they were
+    indexed in MediaObject or by a request that was rolled back."""
+    with resilience.endpoint("s3").guard("head"):
+        try:
+            response = config.aws_session.client().head_object(
+                Bucket=obj.bucket_name, Key=obj.hexdigest
+            )
+        except botocore.exceptions.ClientError as exc:
+            if exc.response["Error"]["Code"] in ("404", "NoSuchKey"):
+                return False
+            raise
+    # keys are digests, a complete object can only have the file's size
+    return response["ContentLength"] == size
+
+
+def put_object(f: UploadedFile, obj: BucketObject):
+    f.seek(0)
+    with resilience.endpoint("s3").guard("put"):
+        # S3 refuses the body if it doesn't match ChecksumSHA256
+        response = config.aws_session.client().put_object(
+            Bucket=obj.bucket_name,
+            Key=obj.hexdigest,
+            Body=f.read(),
+            ChecksumSHA256=obj.base64digest,
+        )
     # Response is a dict:
     #   {
     #    'Expiration': 'string',
@@ -78,6 +181,119 @@ def upload_media(f: UploadedFile) -> BucketObject:
     #    'BucketKeyEnabled': True|False,
     #    'RequestCharged': 'requester'
     # }
-    print(f"s3 put object replied with {response}")
-    retval = BucketObject(hexdigest=hexdigest, base64digest=response["ChecksumSHA256"])
-    return retval
+    logger.debug("s3 put object replied with %s", response)
+    if response["ChecksumSHA256"] != obj.base64digest:
+        raise Exception(
+            f"S3 stored {obj.hexdigest} with checksum {response['ChecksumSHA256']}"
+        )
+
+
+def upload_part(client, obj: BucketObject, upload_id: str, number: int, body: bytes):
+    checksum = b64encode(hashlib.sha256(body).digest()).decode("utf-8")
+    with resilience.endpoint("s3").guard("upload_part"):
+        response = client.upload_part(
+            Bucket=obj.bucket_name,
+            Key=obj.hexdigest,
+            UploadId=upload_id,
+            PartNumber=number,
+            Body=body,
+            ChecksumSHA256=checksum,
+        )
+    return {"ETag": response["ETag"], "PartNumber": number, "ChecksumSHA256": checksum}
+
+
+def upload_multipart(f: UploadedFile, obj: BucketObject):
+    """Uploads f in parts, S3_UPLOAD_CONCURRENCY of them at a time.
+
+    Each part is checked by S3 against its own sha256, and the whole object
+    against the checksum of the parts' checksums."""
+    client = config.aws_session.client()
+    with resilience.endpoint("s3").guard("create_multipart_upload"):
+        upload_id = client.create_multipart_upload(
+            Bucket=obj.bucket_name, Key=obj.hexdigest, ChecksumAlgorithm="SHA256"
+        )["UploadId"]
+    sha256 = hashlib.sha256()
+    parts = []
+    try:
+        with ThreadPoolExecutor(max_workers=config.S3_UPLOAD_CONCURRENCY) as executor:
+            in_flight = set()
+            for number, body in enumerate(
+                read_parts(f, config.S3_MULTIPART_PART_SIZE), start=1
+            ):
+                sha256.update(body)
+                if len(in_flight) >= config.S3_UPLOAD_CONCURRENCY:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    parts.extend(future.result() for future in done)
+                in_flight.add(
+                    executor.submit(upload_part, client, obj, upload_id, number, body)
+                )
+            parts.extend(future.result() for future in in_flight)
+        if sha256.hexdigest() != obj.hexdigest:
+            raise Exception(f"Uploaded file changed while uploading {obj.hexdigest}")
+        parts.sort(key=lambda part: part["PartNumber"])
+        with resilience.endpoint("s3").guard("complete_multipart_upload"):
+            response = client.complete_multipart_upload(
+                Bucket=obj.bucket_name,
+                Key=obj.hexdigest,
+                UploadId=upload_id,
+                MultipartUpload={"Parts": parts},
+            )
+    except BaseException:
+        try:
+            client.abort_multipart_upload(
+                Bucket=obj.bucket_name, Key=obj.hexdigest, UploadId=upload_id
+            )
+        except Exception as exc:
+            logger.warning("could not abort upload of %s: %s", obj.hexdigest, exc)
+        raise
+    logger.debug("s3 complete multipart upload replied with %s", response)
+    checksums = b"".join(b64decode(part["ChecksumSHA256"]) for part in parts)
+    expected = (
+        b64encode(hashlib.sha256(checksums).digest()).decode("utf-8") + f"-{len(parts)}"
+    )
+    if response.get("ChecksumSHA256") != expected:
+        raise Exception(
+            f"S3 stored {obj.hexdigest} with checksum {response.get('ChecksumSHA256')}, expected {expected}"
+        )
+
+
+# fields referring to media objects, counted in MediaObject.refcount
+MEDIA_FIELDS = {Story: "media_sha256", User: "picture_sha256"}
+DEFERRED = object()
+
+
+def count_reference(digest: typing.Optional[str], delta: int):
+    if digest is None:
+        return
+    objects = MediaObject.objects.filter(digest=digest)
+    if delta > 0:
+        MediaObject.objects.get_or_create(digest=digest)
+    else:
+        objects = objects.filter(refcount__gte=-delta)
+    objects.update(refcount=F("refcount") + delta)
+
+
+@receiver(post_init, sender=Story)
+@receiver(post_init, sender=User)
+def media_init_receiver(sender, instance, **kwargs):
+    # the saved value, to tell if a save changes it. Deferred fields aren't
+    # loaded here.
+    instance._saved_media = instance.__dict__.get(MEDIA_FIELDS[sender], DEFERRED)
+
+
+@receiver(post_save, sender=Story)
+@receiver(post_save, sender=User)
+def media_save_receiver(sender, instance, created, **kwargs):
+    old = None if created else instance._saved_media
+    new = instance.__dict__.get(MEDIA_FIELDS[sender], DEFERRED)
+    if old is DEFERRED or new is DEFERRED or old == new:
+        return
+    count_reference(old, -1)
+    count_reference(new, 1)
+    instance._saved_media = new
+
+
+@receiver(post_delete, sender=Story)
+@receiver(post_delete, sender=User)
+def media_delete_receiver(sender, instance, **kwargs):
+    count_reference(instance.__dict__.get(MEDIA_FIELDS[sender]), -1)
@@ -1,9 +1,12 @@
+import datetime
 import html
 import re
 import os
 import sqlite3
 import threading
+import typing
 
+from django.utils import timezone
 from django.utils.safestring import mark_safe
 from django.db.models.signals import post_save, pre_delete
 from django.dispatch import receiver
@@ -25,6 +28,27 @@ def escape_fts(query):
     return query
 
 
+def trigrams(text: str) -> typing.Set[str]:
+    """Lowercase trigrams of text, in the same fashion as the fts5 trigram tokenizer."""
+    text = " ".join(text.lower().split())
+    return {text[i : i + 3] for i in range(len(text) - 2)}
+
+
+def title_similarity(a: str, b: str) -> float:
+    """Jaccard similarity of the trigram sets of two titles."""
+    a, b = trigrams(a), trigrams(b)
+    if not a or not b:
+        return 1.0 if a == b else 0.0
+    return len(a & b) / len(a | b)
+
+
+def fuzzy_fts(query: str) -> str:
+    """Build a trigram fts5 query that matches any trigram of query."""
+    return " OR ".join(
+        '"' + gram.replace('"', '""') + '"' for gram in sorted(trigrams(query))
+    )
+
+
 def run_once(f):
     def wrapper(*args, **kwargs):
         if not hasattr(wrapper.has_run, "value") or not wrapper.has_run.value:
@@ -56,6 +80,9 @@ def fts5_setup():
         connection.execute(
             f"CREATE VIRTUAL TABLE IF NOT EXISTS {config.FTS_STORIES_TABLE_NAME} USING fts5(id UNINDEXED, title, content, content={config.FTS_STORIES_TABLE_NAME}_content, content_rowid=id);"
         )
+        connection.execute(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {config.FTS_STORY_TITLES_TABLE_NAME} USING fts5(id UNINDEXED, title, created UNINDEXED, tokenize='trigram');"
+        )
     return connection
 
 
@@ -86,27 +113,79 @@ def index_comment(obj: Comment):
         )
 
 
+def indexed_story(connection, pk: int):
+    """(title, content) of a story as indexed, or None."""
+    return connection.execute(
+        f"SELECT title, content FROM {config.FTS_STORIES_TABLE_NAME}_content WHERE id=:id",
+        {"id": pk},
+    ).fetchone()
+
+
+def delete_story_tokens(connection, pk: int, indexed):
+    """Remove a story's tokens from the external content fts5 table. They can't
+    be replaced with INSERT OR REPLACE: fts5 has to be given the indexed values
+    to find the tokens to delete."""
+    if indexed is not None:
+        connection.execute(
+            f"INSERT INTO {config.FTS_STORIES_TABLE_NAME}({config.FTS_STORIES_TABLE_NAME}, rowid, title, content) VALUES ('delete', :id, :title, :content)",
+            {"id": pk, "title": indexed[0], "content": indexed[1]},
+        )
+
+
 def index_story(obj: Story):
     connection = fts5_setup()
+    values = {
+        "id": obj.pk,
+        "title": obj.title,
+        "content": obj.content_to_plain_text.strip(),
+    }
     with connection:
+        indexed = indexed_story(connection, obj.pk)
+        if indexed == (values["title"], values["content"]):
+            return
+        delete_story_tokens(connection, obj.pk, indexed)
         connection.execute(
             f"INSERT OR REPLACE INTO {config.FTS_STORIES_TABLE_NAME}_content(id, title, content) VALUES (:id, :title, :content)",
-            {
-                "id": obj.pk,
-                "title": obj.title,
-                "content": obj.content_to_plain_text.strip(),
-            },
+            values,
+        )
+        connection.execute(
+            f"INSERT INTO {config.FTS_STORIES_TABLE_NAME}(rowid, title, content) VALUES (:id, :title, :content)",
+            values,
         )
         connection.execute(
-            f"INSERT OR REPLACE INTO {config.FTS_STORIES_TABLE_NAME}(rowid, title, content) VALUES (:id, :title, :content)",
+            f"INSERT OR REPLACE INTO {config.FTS_STORY_TITLES_TABLE_NAME}(rowid, id, title, created) VALUES (:id, :id, :title, :created)",
             {
                 "id": obj.pk,
                 "title": obj.title,
-                "content": obj.content_to_plain_text.strip(),
+                "created": obj.created.isoformat(),
             },
         )
 
 
+def unindex_story(obj: Story):
+    connection = fts5_setup()
+    with connection:
+        delete_story_tokens(connection, obj.pk, indexed_story(connection, obj.pk))
+        connection.execute(
+            f"DELETE FROM {config.FTS_STORIES_TABLE_NAME}_content WHERE id=:id",
+            {"id": obj.pk},
+        )
+        connection.execute(
+            f"DELETE FROM {config.FTS_STORY_TITLES_TABLE_NAME} WHERE rowid=:id",
+            {"id": obj.pk},
+        )
+
+
+def clear_story_index():
+    connection = fts5_setup()
+    with connection:
+        connection.execute(
+            f"INSERT INTO {config.FTS_STORIES_TABLE_NAME}({config.FTS_STORIES_TABLE_NAME}) VALUES ('delete-all')"
+        )
+        connection.execute(f"DELETE FROM {config.FTS_STORIES_TABLE_NAME}_content")
+        connection.execute(f"DELETE FROM {config.FTS_STORY_TITLES_TABLE_NAME}")
+
+
 def query_comments(query_string: str):
     connection = fts5_setup()
     with connection:
@@ -135,7 +214,9 @@ def query_comments(query_string: str):
     return comments
 
 
-def query_stories(query_string: str):
+def query_stories(query_string: str, fuzzy=False):
+    if fuzzy:
+        return query_story_titles(query_string)
     connection = fts5_setup()
     with connection:
         stories = (
@@ -163,6 +244,74 @@ def query_stories(query_string: str):
     return stories
 
 
+def query_story_titles(
+    query_string: str,
+    since: typing.Optional[datetime.datetime] = None,
+    limit: int = 50,
+):
+    """Fuzzy story title search through the trigram index.
+
+    Matches titles sharing any trigram with query_string, so typos and partial
+    words still match. Results are ordered by descending trigram similarity,
+    which is stored in each story's `similarity` attribute. Stories less
+    similar than FUZZY_TITLE_MIN_SIMILARITY are left out."""
+    query = fuzzy_fts(query_string)
+    if not query:
+        return []
+    sql = f"SELECT rowid, title FROM {config.FTS_STORY_TITLES_TABLE_NAME} WHERE {config.FTS_STORY_TITLES_TABLE_NAME} MATCH :query"
+    params = {"query": query, "limit": limit}
+    if since is not None:
+        sql += " AND created >= :since"
+        params["since"] = since.isoformat()
+    sql += " ORDER BY rank LIMIT :limit"
+    connection = fts5_setup()
+    with connection:
+        matches = {
+            r[0]: title_similarity(query_string, r[1])
+            for r in connection.execute(sql, params)
+        }
+    matches = {
+        pk: similarity
+        for pk, similarity in matches.items()
+        if similarity >= config.FUZZY_TITLE_MIN_SIMILARITY
+    }
+    stories = list(Story.objects.filter(id__in=matches.keys(), active=True))
+    for obj in stories:
+        obj.similarity = matches[obj.pk]
+        obj.snippet = obj.title
+    stories.sort(key=lambda s: s.similarity, reverse=True)
+    return stories
+
+
+def recent_duplicate_titles(title: str, exclude_pk=None):
+    """Stories submitted within DISALLOW_REPOSTS_PERIOD with a title similar to title."""
+    if config.DISALLOW_REPOSTS_PERIOD is None:
+        return []
+    since = timezone.now() - config.DISALLOW_REPOSTS_PERIOD
+    return [
+        obj
+        for obj in query_story_titles(title, since=since)
+        if obj.similarity >= config.DUPLICATE_TITLE_SIMILARITY and obj.pk != exclude_pk
+    ]
+
+
+@receiver(post_save, sender=Story)
+def story_save_receiver(sender, instance, created, raw, using, update_fields, **kwargs):
+    if update_fields is not None and not {"title", "content", "active"} & set(
+        update_fields
+    ):
+        return
+    if instance.active:
+        index_story(instance)
+    else:
+        unindex_story(instance)
+
+
+@receiver(pre_delete, sender=Story)
+def story_delete_receiver(sender, instance, using, **kwargs):
+    unindex_story(instance)
+
+
 @receiver(post_save, sender=Comment)
 def comment_save_receiver(
     sender, instance, created, raw, using, update_fields, **kwargs
@@ -0,0 +1,60 @@
+"""Server-side session store.
+
+Sessions are kept in the cache and backed by the database, so the session
+cookie only carries the session key. Session data is serialized as compact JSON
+and compressed by django's signing, and the serialized size of each value is
+capped by `SESSION_MAX_VALUE_LENGTH`, so large blobs such as rendered HTML
+belong in the cache and are referenced from the session instead (see
+set_comment_preview()).
+
+Expired sessions are deleted from the database by the periodic
+clear_expired_sessions() job, like `manage.py clearsessions` would.
+"""
+
+import json
+import uuid
+from django.contrib.sessions.backends.cached_db import SessionStore as CachedDBStore
+from django.core.cache import cache
+from django.apps import apps
+
+config = apps.get_app_config("sic")
+
+COMMENT_PREVIEW_TIMEOUT = 60 * 60
+
+
+class SessionStore(CachedDBStore):
+    def __setitem__(self, key, value):
+        length = len(json.dumps(value, separators=(",", ":"), ensure_ascii=False))
+        if length > config.SESSION_MAX_VALUE_LENGTH:
+            raise ValueError(
+                f"Session value for {key} is too big: {length} characters, maximum is {config.SESSION_MAX_VALUE_LENGTH}"
+            )
+        super().__setitem__(key, value)
+
+
+def clear_expired_sessions(job):
+    SessionStore.clear_expired()
+
+
+def set_comment_preview(request, comment_pk: str, text: str, html: str):
+    """Store a comment preview. Only the input and a reference to the rendered
+    HTML are kept in the session."""
+    ref = f"comment-preview-{uuid.uuid4().hex}"
+    cache.set(ref, str(html), timeout=COMMENT_PREVIEW_TIMEOUT)
+    request.session["comment_preview"] = {comment_pk: {"input": text, "ref": ref}}
+
+
+def get_comment_preview(request, comment_pk: str):
+    """Returns (input, html) of the comment preview, if there is one."""
+    try:
+        preview = request.session["comment_preview"][comment_pk]
+    except KeyError:
+        return None
+    html = cache.get(preview["ref"], None)
+    if html is None:
+        # Evicted, or stored by another process's local memory cache.
+        from sic.markdown import comment_to_html
+
+        html = comment_to_html(preview["input"])
+        cache.set(preview["ref"], str(html), timeout=COMMENT_PREVIEW_TIMEOUT)
+    return preview["input"], html
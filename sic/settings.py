@@ -53,7 +53,7 @@ MIDDLEWARE = [
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
 ]
 
-SESSION_ENGINE = "django.contrib.sessions.backends.signed_cookies"
+SESSION_ENGINE = "sic.sessions"
 
 ROOT_URLCONF = "sic.urls"
 
@@ -78,6 +78,15 @@ TEMPLATES = [
             ],
         },
     },
+    {
+        # Jinja2 versions of the most rendered templates, see sic/jinja.py
+        "BACKEND": "django.template.backends.jinja2.Jinja2",
+        "DIRS": [],
+        "APP_DIRS": True,
+        "OPTIONS": {
+            "environment": "sic.jinja.environment",
+        },
+    },
 ]
 
 WSGI_APPLICATION = "sic.wsgi.application"
@@ -146,6 +155,10 @@ if DEBUG:
 # EMAIL_PORT = 25
 
 
+# Send blockchain API requests to a local stand-in instead, e.g.
+# "127.0.0.1:8100", see "python manage.py blockchain_standin"
+BLOCKCHAIN_STANDIN_ADDRESS = None
+
 # Allow local settings overrides
 
 try:
@@ -0,0 +1,129 @@
+"""Data shown in story list rows (posts/story_list_item.html), loaded for a
+whole page of stories with a fixed number of queries."""
+
+import collections
+import hashlib
+import logging
+from django.core.cache import cache
+from django.db.models import Count
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from sic.models import Story, Comment, Tag, User
+from sic.viewer_state import ViewerState, csrf_secret_digest
+
+logger = logging.getLogger("sic")
+
+TAG_TABLE_CACHE_KEY = "tag-table"
+
+
+def tag_table() -> dict:
+    """All tags by pk."""
+    table = cache.get(TAG_TABLE_CACHE_KEY)
+    if table is None:
+        table = {tag.pk: tag for tag in Tag.objects.all()}
+        cache.set(TAG_TABLE_CACHE_KEY, table, timeout=60 * 60 * 24)
+    return table
+
+
+@receiver(post_save, sender=Tag)
+@receiver(post_delete, sender=Tag)
+def tag_table_receiver(sender, **kwargs):
+    cache.delete(TAG_TABLE_CACHE_KEY)
+
+
+def load_story_rows(stories, user):
+    """Set comment counts, tags, authors, media URLs and the viewer's votes and
+    bookmarks on stories, in place of the lookups each row would make."""
+    stories = [story for story in stories if isinstance(story, Story)]
+    if not stories:
+        return
+    story_pks = [story.pk for story in stories]
+
+    counts = dict(
+        Comment.objects.filter(story_id__in=story_pks, deleted=False)
+        .values("story_id")
+        .annotate(count=Count("id"))
+        .values_list("story_id", "count")
+    )
+
+    tags = tag_table()
+    story_tags = collections.defaultdict(list)
+    for story_id, tag_id in Story.tags.through.objects.filter(
+        story_id__in=story_pks
+    ).values_list("story_id", "tag_id"):
+        if tag_id not in tags:
+            # Created after the table was cached by another process.
+            cache.delete(TAG_TABLE_CACHE_KEY)
+            tags = tag_table()
+        story_tags[story_id].append(tags[tag_id])
+
+    users = User.objects.in_bulk({story.user_id for story in stories})
+    for user_obj in users.values():
+        user_obj.__dict__["is_banned"] = user_obj.banned_by_user_id is not None
+
+    media_urls = {}
+    with_media = [story for story in stories if story.media_sha256 is not None]
+    if with_media:
+        from sic.s3 import BucketObject
+
+        try:
+            urls = BucketObject.urls(
+                BucketObject.from_sha256(story.media_sha256) for story in with_media
+            )
+            media_urls = {story.pk: url for story, url in zip(with_media, urls)}
+        except Exception:
+            logger.warning("could not presign story media", exc_info=True)
+
+    for story in stories:
+        story.__dict__["active_comments_count"] = counts.get(story.pk, 0)
+        story.__dict__["tag_list"] = sorted(
+            story_tags[story.pk], key=lambda tag: tag.name
+        )
+        story.user = users[story.user_id]
+        if story.media_sha256 is None or story.pk in media_urls:
+            story.__dict__["media_url"] = media_urls.get(story.pk, None)
+
+    viewer = ViewerState.of(user)
+    viewer.preload(stories=stories)
+    viewer.load()
+
+
+def row_fragment_key(context) -> str:
+    """Digest of everything a story_list_item.html row shows, used to cache the
+    rendered row. Rows are never invalidated: any change to the story, its
+    author, tags or the viewer gives a new key."""
+    story = context["story"]
+    request = context["request"]
+    author = story.user
+    parts = [
+        story.pk,
+        story.last_active.timestamp(),
+        story.title,
+        story.content_warning,
+        story.pinned,
+        getattr(story, "pinned_status", False),
+        story.story_hash,
+        story.media_sha256,
+        story.karma,
+        story.active_comments_count,
+        [(tag.pk, tag.name, tag.hex_color) for tag in story.tag_list],
+        author.pk,
+        str(author),
+        author.avatar_id,
+        author.avatar_title,
+        author.birth_hash,
+        author.is_banned,
+        author.is_new_user,
+        context.get("show_avatars"),
+        context.get("show_colors"),
+        context.get("show_stories_with_content_warning"),
+        request.get_full_path(),
+    ]
+    if request.user.is_authenticated:
+        parts += [
+            request.user.pk,
+            ViewerState.of(request.user).story_is_upvoted(story),
+            csrf_secret_digest(request),
+        ]
+    return hashlib.sha256(repr(parts).encode()).hexdigest()
@@ -1,6 +1,9 @@
 import collections
+import hashlib
 from django import template
+from django.apps import apps
 from django.conf import settings
+from django.core.cache import cache
 from django.utils.http import urlencode
 from django.utils.html import format_html
 from django.utils.safestring import mark_safe
@@ -10,6 +13,10 @@ from django.template.base import Token, Node, kwarg_re
 from django.template import Context, Template
 from django.template.loader import render_to_string
 from sic.models import Comment
+from sic.viewer_state import ViewerState, csrf_secret_digest
+from sic import jinja
+
+config = apps.get_app_config("sic")
 
 register = template.Library()
 
@@ -27,8 +34,49 @@ class CommentNode:
         return str(self)
 
 
-@register.simple_tag(takes_context=True)
-def render_comments(
+def viewer_state(context, request):
+    """Returns the parts of the viewing user's state that comment fragments
+    depend on, and the set of comment pks they have upvoted.
+
+    Returns None if fragments shouldn't be cached for this viewer."""
+    user = request.user
+    if not user.is_authenticated:
+        return f"anonymous:{context.get('show_colors')}", set()
+    if request.session.get("comment_preview", None):
+        return None
+    secret = csrf_secret_digest(request)
+    viewer = ViewerState.of(user)
+    viewer.load()
+    upvoted = viewer.upvoted_comments
+    return (
+        f"{user.pk}:{user.is_moderator}:{context.get('show_colors')}:{secret}",
+        upvoted,
+    )
+
+
+def thread_context(engine, request) -> dict:
+    """The context processors' variables, computed once for all the comments of
+    a thread. Comments are rendered with these and their own variables only,
+    like render_to_string() would, not with the including template's context."""
+    ret = {}
+    for processor in engine.template_context_processors:
+        ret.update(processor(request))
+    return ret
+
+
+def fragment_key(node, level, state, upvoted, child_keys):
+    """Cache key of a comment's fragment, or None if it shouldn't be cached
+    because the comment or one of its replies only has a fallback render."""
+    obj = node.obj
+    if obj.rendered_hash is None or None in child_keys:
+        return None
+    key = hashlib.sha256(
+        f"{obj.pk}:{obj.last_modified.timestamp()}:{obj.karma}:{obj.deleted}:{obj.hat_id}:{obj.rendered_hash}:{level}:{obj.pk in upvoted}:{state}:{','.join(child_keys)}".encode()
+    ).hexdigest()
+    return f"comment-fragment-{key}"
+
+
+def iter_rendered_comments(
     context,
     request,
     comments,
@@ -38,7 +86,18 @@ def render_comments(
     only_roots=True,
     edit_comment_pk=None,
     edit_comment_form=None,
+    root=None,
 ):
+    """Render comment threads with posts/comment.html, yielding each thread as
+    soon as it is rendered.
+
+    If root is given, only its subthread is rendered.
+
+    The template is compiled once and rendered with each comment's variables
+    and those of thread_context(). Each comment's fragment (including its
+    replies) is cached under a key derived from the comment, its replies'
+    keys, the viewer's state and the page's path, so unchanged subtrees are
+    reused across requests."""
 
     if isinstance(comments, Comment):
         comments = {comments.id: CommentNode(comments)}
@@ -49,27 +108,71 @@ def render_comments(
         if comments[c].parent is not None and comments[c].parent in comments:
             comments[comments[c].parent].children.append(c)
 
+    # order_q has parents before their replies, and popping from it completes
+    # threads in the order of roots.
     order_q = collections.deque()
+    if root is not None:
+        roots = [root.pk] if root.pk in comments else []
+    else:
+        roots = [c for c in comments if comments[c].parent is None]
     if only_roots:
-        q = collections.deque(
-            (level, c) for c in comments if comments[c].parent is None
-        )
+        q = collections.deque((level, c) for c in roots)
     else:
         q = collections.deque((level, c) for c in comments)
     while len(q) != 0:
-        (level, root) = q.pop()
-        order_q.append((level, root))
-        if len(comments[root].children) > 0:
-            for c in comments[root].children:
-                q.append((level + 1, c))
+        (lvl, node) = q.pop()
+        order_q.append((lvl, node))
+        if len(comments[node].children) > 0:
+            for c in comments[node].children:
+                q.append((lvl + 1, c))
+
+    ViewerState.of(request.user).preload(comments=comments.keys())
+    state = viewer_state(context, request)
+    keys = {}
+    cached = {}
+    if state is not None:
+        state, upvoted = state
+        # comment.html links back to the current page with ?next=
+        state = f"{state}:{show_story}:{request.get_full_path()}"
+        for (lvl, leaf) in reversed(order_q):
+            keys[(lvl, leaf)] = fragment_key(
+                comments[leaf],
+                lvl,
+                state,
+                upvoted,
+                [keys[(lvl + 1, c)] for c in comments[leaf].children],
+            )
+        cached = cache.get_many(k for k in keys.values() if k is not None)
+
+    # Only render fragments that aren't cached and aren't part of a cached
+    # ancestor.
+    needed = set()
+    root_pks = set(roots)
+    for (lvl, leaf) in order_q:
+        if (lvl, leaf) in needed or not only_roots or leaf in root_pks:
+            needed.add((lvl, leaf))
+            if keys.get((lvl, leaf), None) not in cached:
+                needed.update((lvl + 1, c) for c in comments[leaf].children)
 
+    engine = context.template.engine
+    base = thread_context(engine, request)
+    if config.JINJA2_TEMPLATES:
+        template = jinja.get_template("posts/comment.html")
+        base = jinja.template_context(Context(base), request)
+    else:
+        template = engine.get_template("posts/comment.html")
+    new_fragments = {}
     while len(order_q) != 0:
         (lvl, leaf) = order_q.pop()
-        children = comments[leaf].children
-        replies = [rendered[c] for c in children]
-        rendered[leaf] = render_to_string(
-            "posts/comment.html",
-            context={
+        if (lvl, leaf) not in needed:
+            continue
+        key = keys.get((lvl, leaf), None)
+        if key in cached:
+            rendered[leaf] = cached[key]
+        else:
+            children = comments[leaf].children
+            replies = [rendered[c] for c in children]
+            values = {
                 "comment": comments[leaf].obj,
                 "replies": replies,
                 "reply_form": reply_form,
@@ -77,12 +180,37 @@ def render_comments(
                 "show_story": show_story,
                 "edit_comment_pk": edit_comment_pk,
                 "edit_comment_form": edit_comment_form,
-            },
-            request=request,
-        )
+            }
+            if config.JINJA2_TEMPLATES:
+                rendered[leaf] = mark_safe(template.render({**base, **values}))
+            else:
+                rendered[leaf] = mark_safe(
+                    template.render(
+                        Context({**base, **values}, autoescape=engine.autoescape)
+                    )
+                )
+            if key is not None:
+                new_fragments[key] = str(rendered[leaf])
+        if only_roots and lvl == level and leaf in root_pks:
+            if new_fragments:
+                cache.set_many(
+                    new_fragments, timeout=config.COMMENT_FRAGMENT_CACHE_TIMEOUT
+                )
+                new_fragments = {}
+            yield rendered[leaf]
 
-    if only_roots:
-        ret = "".join(rendered[c] for c in comments if comments[c].parent is None)
-    else:
-        ret = "".join(rendered[c] for c in comments)
-    return mark_safe(ret)
+    if new_fragments:
+        cache.set_many(new_fragments, timeout=config.COMMENT_FRAGMENT_CACHE_TIMEOUT)
+    if not only_roots:
+        for c in comments:
+            yield rendered[c]
+
+
+@register.simple_tag(takes_context=True)
+def render_comments(context, request, comments, reply_form, **kwargs):
+    """Render comment threads, see iter_rendered_comments()."""
+    return mark_safe(
+        "".join(
+            iter_rendered_comments(context, request, comments, reply_form, **kwargs)
+        )
+    )
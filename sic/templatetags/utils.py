@@ -7,9 +7,13 @@ from django.template.defaulttags import URLNode, url
 from django.template.exceptions import TemplateSyntaxError
 from django.template.base import Token, Node, kwarg_re
 from django.core.cache import cache
+from django.core.cache.utils import make_template_fragment_key
 import subprocess, os
 
 from sic.flatpages import DocumentationFlatPage, ExternalLinkFlatPage, CommunityFlatPage
+from sic import sessions, jinja
+from sic.viewer_state import ViewerState
+from sic.story_rows import row_fragment_key
 from django.apps import apps
 
 config = apps.get_app_config("sic")
@@ -32,12 +36,16 @@ class URLNextNode(Node):
     def render(self, context):
         inner = self.url_node.render(context)
         request = self.request.resolve(context)
-        full_path = request.get_full_path()
-        # prevent infinite loops for bots
-        _next = not full_path.startswith(inner)
-        _next_s = urlencode({"next": full_path})
+        return with_next(inner, request)
 
-        return inner + ("?" + _next_s) if _next else ""
+
+def with_next(inner: str, request) -> str:
+    full_path = request.get_full_path()
+    # prevent infinite loops for bots
+    _next = not full_path.startswith(inner)
+    _next_s = urlencode({"next": full_path})
+
+    return inner + ("?" + _next_s) if _next else ""
 
 
 @register.tag
@@ -68,14 +76,14 @@ def url_with_next(parser, token):
 def story_is_bookmarked(user, story):
     if not user.is_authenticated:
         return False
-    return user.saved_stories.filter(pk=story.pk).exists()
+    return ViewerState.of(user).story_is_bookmarked(story)
 
 
 @register.simple_tag
 def comment_is_bookmarked(user, comment):
     if not user.is_authenticated:
         return False
-    return user.saved_comments.filter(pk=comment.pk).exists()
+    return ViewerState.of(user).comment_is_bookmarked(comment)
 
 
 @register.simple_tag
@@ -119,14 +127,10 @@ def get_comment_preview(context, request, comment_pk: int):
     context["preview_input"] = ""
     if isinstance(comment_pk, int):
         comment_pk = str(comment_pk)
-    if (
-        "comment_preview" in request.session
-        and comment_pk in request.session["comment_preview"]
-    ):
-        context["preview_input"] = request.session["comment_preview"][comment_pk][
-            "input"
-        ]
-        return mark_safe(request.session["comment_preview"][comment_pk]["html"])
+    preview = sessions.get_comment_preview(request, comment_pk)
+    if preview is not None:
+        context["preview_input"], html = preview
+        return mark_safe(html)
     return None
 
 
@@ -135,7 +139,30 @@ def comment_is_upvoted(context):
     user = context["request"].user
     if not user.is_authenticated:
         return False
-    return user.votes.filter(comment=context["comment"].pk).exists()
+    return ViewerState.of(user).comment_is_upvoted(context["comment"])
+
+
+@register.simple_tag(takes_context=True)
+def story_row_key(context):
+    return row_fragment_key(context)
+
+
+@register.simple_tag(takes_context=True)
+def story_list_item(context, story):
+    """Renders posts/story_list_item.html for story, with the Jinja2 version if
+    config.JINJA2_TEMPLATES is set."""
+    if not config.JINJA2_TEMPLATES:
+        template = context.template.engine.get_template("posts/story_list_item.html")
+        with context.push(story=story):
+            return template.render(context)
+    values = jinja.template_context(context, context["request"])
+    values["story"] = story
+    key = make_template_fragment_key("story_row_jinja", [row_fragment_key(values)])
+    ret = cache.get(key)
+    if ret is None:
+        ret = jinja.get_template("posts/story_list_item.html").render(values)
+        cache.set(key, ret, timeout=config.STORY_ROW_CACHE_TIMEOUT)
+    return mark_safe(ret)
 
 
 @register.simple_tag(takes_context=True)
@@ -143,7 +170,7 @@ def story_is_upvoted(context):
     user = context["request"].user
     if not user.is_authenticated:
         return False
-    return user.votes.filter(story=context["story"].pk, comment=None).exists()
+    return ViewerState.of(user).story_is_upvoted(context["story"])
 
 
 @register.simple_tag(takes_context=False)
@@ -0,0 +1,135 @@
+"""Lifetimes (TTL) of users' stories, as returned by the blockchain API.
+
+Values are served from the cache, and stale values are served while a
+background thread refreshes them: rendering a page never waits for the API.
+Refreshes are single-flight, a user queued or being refreshed isn't queued
+again, and are sent for up to TTL_REFRESH_BATCH_SIZE users at a time, see
+blockchain.get_ttls().
+
+The cache holds (value, fresh_until) pairs for TTL_STALE_TIMEOUT seconds. A
+user without any cached value gets UNKNOWN until the refresh is done.
+"""
+
+import json
+import logging
+import threading
+import time
+from django.apps import apps
+from django.core.cache import cache
+
+config = apps.get_app_config("sic")
+
+logger = logging.getLogger("sic")
+
+UNKNOWN = ("", "Checking lifetime...")
+
+queue = {}
+in_flight = set()
+queue_lock = threading.Lock()
+wake = threading.Event()
+
+
+def cache_key(user) -> str:
+    return f"{user}-ttl"
+
+
+def parse(resp) -> tuple:
+    """Returns (ttl, message) from a getTTL reply, or from the exception
+    raised instead."""
+    if isinstance(resp, Exception):
+        msg = str(resp)
+        try:
+            msg = json.loads(msg)
+            if isinstance(msg, dict) and "message" in msg:
+                msg = msg["message"]
+        except json.JSONDecodeError:
+            pass
+        return 0, msg
+    msg = ""
+    try:
+        d = json.loads(resp)
+        if isinstance(d, dict) and "message" in d:
+            msg = d["message"]
+            resp = 0
+    except json.JSONDecodeError:
+        pass
+    return resp, msg
+
+
+def get(user) -> tuple:
+    entry = cache.get(cache_key(user))
+    if entry is None:
+        request_refresh(user)
+        return UNKNOWN
+    value, fresh_until = entry
+    if time.time() >= fresh_until:
+        request_refresh(user)
+    return tuple(value)
+
+
+def request_refresh(user):
+    key = cache_key(user)
+    with queue_lock:
+        if key in queue or key in in_flight:
+            return
+        # other processes sharing the cache
+        if not cache.add(f"{key}-refreshing", True, timeout=config.TTL_REFRESH_TIMEOUT):
+            return
+        queue[key] = user.birth_hash
+    wake.set()
+
+
+def store(items: dict):
+    """Caches {cache key: (ttl, message)}."""
+    fresh_until = time.time() + config.TTL_FRESH_TIMEOUT
+    cache.set_many(
+        {key: (value, fresh_until) for key, value in items.items()},
+        timeout=config.TTL_STALE_TIMEOUT,
+    )
+    cache.delete_many([f"{key}-refreshing" for key in items])
+
+
+def fetch(keys: dict) -> dict:
+    """Fetches {cache key: birth hash} in one round, returns {cache key:
+    (ttl, message)}."""
+    from sic import blockchain
+
+    replies = blockchain.get_ttls(set(keys.values()))
+    missing = blockchain.BlockchainError("No reply for birth hash.")
+    return {
+        key: parse(replies.get(birth_hash, missing)) for key, birth_hash in keys.items()
+    }
+
+
+def refresh(user) -> tuple:
+    """Refreshes user's TTL right away, for when it's known to have changed."""
+    key = cache_key(user)
+    value = fetch({key: user.birth_hash})[key]
+    store({key: value})
+    return value
+
+
+def refresh_queued():
+    while True:
+        with queue_lock:
+            if not queue:
+                return
+            keys = dict(list(queue.items())[: config.TTL_REFRESH_BATCH_SIZE])
+            for key in keys:
+                del queue[key]
+            in_flight.update(keys)
+        try:
+            store(fetch(keys))
+        finally:
+            with queue_lock:
+                in_flight.difference_update(keys)
+
+
+def worker():
+    while True:
+        wake.wait()
+        wake.clear()
+        try:
+            refresh_queued()
+        except Exception:
+            logger.exception("ttl refresh error")
@@ -58,6 +58,7 @@ urlpatterns = [
         name="moderation_banned_domains",
     ),
     path("moderation/", moderation.overview, name="moderation"),
+    path("moderation/metrics/", moderation.metrics, name="moderation_metrics"),
     path("moderation/s/<int:story_pk>/", moderation.story, name="moderation_story"),
     path(
         "moderation/s/<int:story_pk>/<str:slug>",
@@ -87,6 +88,11 @@ urlpatterns = [
         RedirectView.as_view(pattern_name="moderation_story_slug", permanent=False),
         name="story_moderate_redirect",
     ),
+    path(
+        "s/<int:story_pk>/<str:slug>/thread/<int:comment_pk>/",
+        stories.story,
+        name="story_thread",
+    ),
     path(
         "s/<int:story_pk>/<str:slug>/upvote/<int:comment_pk>/",
         views.upvote_comment,
@@ -249,6 +255,7 @@ urlpatterns = [
     ),
     path("accounts/profile/edit/", account.edit_profile, name="edit_profile"),
     path("accounts/profile/avatar/", account.edit_avatar, name="edit_avatar"),
+    path("avatars/<str:digest>/", account.avatar, name="avatar"),
     path("accounts/settings/", account.edit_settings, name="edit_settings"),
     path("accounts/filters/", account.edit_filters, name="edit_filters"),
     path("accounts/filters/add/tag/", account.add_tag_filter, name="add_tag_filter"),
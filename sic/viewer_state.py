@@ -0,0 +1,110 @@
+"""Votes and bookmarks of the viewing user for the items shown on a page.
+
+Views register the stories and comments they are about to render with
+ViewerState.of(request.user).preload(...), and the template tags in
+sic/templatetags/utils.py answer from sets, with one query per relation for all
+the registered items instead of one query per rendered item. The state is kept
+on the user object, which is loaded anew for every request.
+"""
+
+import hashlib
+from django.middleware.csrf import get_token
+
+from sic.models import Story, Comment, Vote, StoryBookmark, CommentBookmark
+
+
+def csrf_secret_digest(request) -> str:
+    """Cached fragments with forms contain a masked CSRF token, which is valid
+    for as long as the secret doesn't change."""
+    get_token(request)
+    return hashlib.sha256(request.META.get("CSRF_COOKIE", "").encode()).hexdigest()
+
+
+def pks(items):
+    return {item if isinstance(item, int) else item.pk for item in items}
+
+
+class ViewerState:
+    def __init__(self, user):
+        self.user = user
+        self.pending_stories = set()
+        self.pending_comments = set()
+        self.loaded_stories = set()
+        self.loaded_comments = set()
+        self.upvoted_stories = set()
+        self.upvoted_comments = set()
+        self.bookmarked_stories = set()
+        self.bookmarked_comments = set()
+
+    @staticmethod
+    def of(user) -> "ViewerState":
+        state = getattr(user, "_viewer_state", None)
+        if state is None:
+            state = ViewerState(user)
+            user._viewer_state = state
+        return state
+
+    def preload(self, stories=(), comments=()):
+        """Register stories and comments (objects or pks) that will be shown."""
+        self.pending_stories |= pks(stories) - self.loaded_stories
+        self.pending_comments |= pks(comments) - self.loaded_comments
+
+    def load(self):
+        if not self.user.is_authenticated:
+            self.pending_stories.clear()
+            self.pending_comments.clear()
+            return
+        if self.pending_stories:
+            stories = self.pending_stories
+            self.upvoted_stories |= set(
+                Vote.objects.filter(
+                    user=self.user, story_id__in=stories, comment=None
+                ).values_list("story_id", flat=True)
+            )
+            self.bookmarked_stories |= set(
+                StoryBookmark.objects.filter(
+                    user=self.user, story_id__in=stories
+                ).values_list("story_id", flat=True)
+            )
+            self.loaded_stories |= stories
+            self.pending_stories = set()
+        if self.pending_comments:
+            comments = self.pending_comments
+            self.upvoted_comments |= set(
+                Vote.objects.filter(
+                    user=self.user, comment_id__in=comments
+                ).values_list("comment_id", flat=True)
+            )
+            self.bookmarked_comments |= set(
+                CommentBookmark.objects.filter(
+                    user=self.user, comment_id__in=comments
+                ).values_list("comment_id", flat=True)
+            )
+            self.loaded_comments |= comments
+            self.pending_comments = set()
+
+    def story(self, story):
+        pk = story if isinstance(story, int) else story.pk
+        if pk not in self.loaded_stories:
+            self.preload(stories=[pk])
+            self.load()
+        return pk
+
+    def comment(self, comment):
+        pk = comment if isinstance(comment, int) else comment.pk
+        if pk not in self.loaded_comments:
+            self.preload(comments=[pk])
+            self.load()
+        return pk
+
+    def story_is_upvoted(self, story) -> bool:
+        return self.story(story) in self.upvoted_stories
+
+    def story_is_bookmarked(self, story) -> bool:
+        return self.story(story) in self.bookmarked_stories
+
+    def comment_is_upvoted(self, comment) -> bool:
+        return self.comment(comment) in self.upvoted_comments
+
+    def comment_is_bookmarked(self, comment) -> bool:
+        return self.comment(comment) in self.bookmarked_comments
@@ -37,6 +37,9 @@ from sic.views.utils import (
 )
 from sic.markdown import comment_to_html
 from sic.search import query_comments, query_stories
+from sic.sessions import set_comment_preview
+from sic.viewer_state import ViewerState
+from sic.story_rows import load_story_rows
 from sic import mail
 
 
@@ -46,8 +49,8 @@ def preview_comment(request):
         return HttpResponseBadRequest("Request url should have a ?next= GET parameter.")
     if "comment_preview" in request.session:
         request.session["comment_preview"] = {}
-    # The preview is saved in the user's session, and then retrieved in
-    # the template by the tag `get_comment_preview` located in
+    # The preview is saved with sic.sessions.set_comment_preview, and then
+    # retrieved in the template by the tag `get_comment_preview` located in
     # sic/templatetags/utils.py which puts the preview in the rendering
     # context.
     comment = None
@@ -58,10 +61,24 @@ def preview_comment(request):
         else:
             comment_pk = "null"
         text = request.POST["text"]
-        request.session["comment_preview"] = {comment_pk: {}}
-        request.session["comment_preview"][comment_pk]["input"] = text
-        request.session["comment_preview"][comment_pk]["html"] = comment_to_html(text)
-        request.session.modified = True
+        if len(text) > config.MARKDOWN_MAX_INPUT_LENGTH:
+            messages.add_message(
+                request,
+                messages.ERROR,
+                f"Comment is too long to preview: {len(text)} characters, maximum is {config.MARKDOWN_MAX_INPUT_LENGTH}.",
+            )
+            return redirect(request.GET["next"])
+        try:
+            set_comment_preview(request, comment_pk, text, comment_to_html(text))
+        except ValueError:
+            # Escaping can make the serialized text longer than
+            # SESSION_MAX_VALUE_LENGTH.
+            messages.add_message(
+                request,
+                messages.ERROR,
+                "Comment is too long to preview.",
+            )
+            return redirect(request.GET["next"])
         if comment:
             return redirect(request.GET["next"] + "#" + comment.slugify)
         return redirect(request.GET["next"])
@@ -185,6 +202,7 @@ def agg_index(request, taggregation_pk, slug, page_num=1):
                 },
             )
         )
+    load_story_rows(page, request.user)
     return render(
         request,
         "index.html",
@@ -250,6 +268,7 @@ def index(request, page_num=1):
     except InvalidPage:
         # page_num is bigger than the actual number of pages
         return redirect(reverse("index_page", kwargs={"page_num": paginator.num_pages}))
+    load_story_rows(page, request.user)
     return render(
         request,
         "index.html",
@@ -294,6 +313,7 @@ def edit_comment(request, comment_pk):
                     before_text, comment_obj, request.user, reason
                 )
                 comment_obj.text = form.cleaned_data["text"]
+                comment_obj.last_modified = make_aware(datetime.now())
                 comment_obj.save()
                 if "comment_preview" in request.session:
                     request.session["comment_preview"] = {}
@@ -350,6 +370,7 @@ def delete_comment(request, comment_pk):
                 ModerationLogEntry.delete_comment(
                     comment_obj, request.user, form.cleaned_data["deletion_reason"]
                 )
+                comment_obj.last_modified = make_aware(datetime.now())
                 comment_obj.save()
                 if "comment_preview" in request.session:
                     request.session["comment_preview"] = {}
@@ -484,12 +505,16 @@ def search(request):
                 comments = query_comments(form.cleaned_data["text"])
                 count = len(comments)
             if form.cleaned_data["search_in"] in ["stories", "both"]:
-                stories = query_stories(form.cleaned_data["text"])
+                stories = query_stories(
+                    form.cleaned_data["text"], fuzzy=form.cleaned_data["fuzzy"]
+                )
                 if count is None:
                     count = 0
                 count += len(stories)
     else:
         form = SearchCommentsForm()
+    if stories:
+        ViewerState.of(request.user).preload(stories=stories)
     return render(
         request,
         "posts/search.html",
@@ -537,6 +562,7 @@ def domain(request, slug, page_num=1):
         fields=domain.ORDER_BY_FIELDS,
         initial={"order_by": order_by, "ordering": ordering},
     )
+    load_story_rows(page, request.user)
     return render(
         request,
         "posts/all_stories.html",
@@ -17,7 +17,8 @@ from django.contrib.auth.decorators import login_required
 from django.contrib.sites.models import Site
 from django.utils.timezone import make_aware
 from django.utils.safestring import mark_safe
-from django.views.decorators.http import require_http_methods, require_safe
+from django.views.decorators.http import require_http_methods, require_safe, etag
+from django.views.decorators.cache import cache_control
 from django.core.mail import EmailMessage
 from django.apps import apps
 
@@ -25,6 +26,7 @@ config = apps.get_app_config("sic")
 from wand.image import Image
 from sic.auth import AuthToken, SSHAuthenticationForm
 from sic.models import (
+    Avatar,
     User,
     Invitation,
     Story,
@@ -61,9 +63,11 @@ from sic.views.utils import (
     InvalidPage,
     check_next_url,
 )
+from sic.viewer_state import ViewerState
+from sic.story_rows import load_story_rows
 
-# Convert image to data:image/... in order to save avatars as strings in database
-def generate_image_thumbnail(blob):
+# Convert image to a webp thumbnail, see Avatar.store()
+def generate_image_thumbnail(blob) -> bytes:
     with Image(blob=blob) as i:
         with i.convert("webp") as page:
             page.alpha_channel = False
@@ -72,7 +76,18 @@ def generate_image_thumbnail(blob):
             ratio = 100.0 / (width * 1.0)
             new_height = int(ratio * height)
             page.thumbnail(width=100, height=new_height)
-            return page.data_url()
+            return page.make_blob()
+
+
+@require_safe
+@etag(lambda request, digest: digest)
+@cache_control(public=True, max_age=365 * 24 * 60 * 60, immutable=True)
+def avatar(request, digest):
+    try:
+        obj = Avatar.objects.get(digest=digest)
+    except Avatar.DoesNotExist:
+        raise Http404("Avatar does not exist") from Avatar.DoesNotExist
+    return HttpResponse(bytes(obj.data), content_type=obj.content_type)
 
 
 def login(request):
@@ -215,8 +230,7 @@ def edit_avatar(request):
             img = form.cleaned_data["new_avatar"]
             avatar_title = form.cleaned_data["avatar_title"]
             if img:
-                data_url = generate_image_thumbnail(img)
-                request.user.avatar = data_url
+                request.user.avatar = Avatar.store(generate_image_thumbnail(img))
             request.user.avatar_title = avatar_title if len(avatar_title) > 0 else None
             request.user.save()
             messages.add_message(request, messages.SUCCESS, "Avatar updated.")
@@ -471,6 +485,8 @@ def profile_posts(request, name, page_num=1):
                 kwargs={"page_num": paginator.num_pages},
             )
         )
+    load_story_rows([p for p in page if p.is_story], request.user)
+    ViewerState.of(request.user).preload(comments=[p for p in page if not p.is_story])
     return render(
         request,
         "account/profile_posts.html",
@@ -651,6 +667,10 @@ def bookmarks(request, page_num=1):
                 kwargs={"page_num": paginator.num_pages},
             )
         )
+    ViewerState.of(request.user).preload(
+        stories=[b.story_id for b in page if b.is_story],
+        comments=[b.comment_id for b in page if not b.is_story],
+    )
     return render(
         request,
         "account/bookmarks.html",
@@ -1333,9 +1353,11 @@ def restart_account(request):
             }
 
             birth_hash = blockchain.spawn_story(password, json.dumps(blockchain_data))
-            data_url = generate_image_thumbnail(form.cleaned_data["picture"])
-            user.avatar = data_url
+            user.avatar = Avatar.store(
+                generate_image_thumbnail(form.cleaned_data["picture"])
+            )
             user.birth_hash = birth_hash
+            user.picture_sha256 = media_sha256
             user.save()
             messages.add_message(
                 request,
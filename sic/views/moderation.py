@@ -85,6 +85,17 @@ def banned_domains(request):
     )
 
 
+@login_required
+def metrics(request):
+    if (not request.user.is_moderator) and (not request.user.is_admin):
+        raise PermissionDenied("You are not a moderator.")
+    from sic import resilience
+
+    return HttpResponse(
+        resilience.metrics(), content_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
 @login_required
 def overview(request):
     if (not request.user.is_moderator) and (not request.user.is_admin):
@@ -3,6 +3,8 @@ from datetime import datetime
 import hashlib
 import urllib.request
 import json
+import logging
+import uuid
 from django.db import transaction
 from django.shortcuts import render, redirect
 from django.urls import reverse
@@ -11,10 +13,22 @@ from django.views.decorators.http import require_safe
 from django.contrib.auth.decorators import login_required, permission_required
 from django.core.exceptions import PermissionDenied
 from django.utils.timezone import make_aware
-from django.http import Http404, HttpResponse, HttpResponseBadRequest, JsonResponse
+from django.http import (
+    Http404,
+    HttpResponse,
+    HttpResponseBadRequest,
+    JsonResponse,
+    StreamingHttpResponse,
+)
+from django.middleware.csrf import get_token
+from django.template.context import make_context
+from django.template.loader import get_template, render_to_string
+from django.utils.safestring import mark_safe
 from django.apps import apps
 
 config = apps.get_app_config("sic")
+
+logger = logging.getLogger("sic")
 from sic.models import Story, StoryKind, Comment, Notification, Tag
 from sic.forms import (
     SubmitCommentForm,
@@ -31,21 +45,36 @@ from sic.views.utils import (
     check_next_url,
 )
 from sic.moderation import ModerationLogEntry
-from sic import blockchain
+from sic.search import recent_duplicate_titles
+from sic import anchoring
+from sic.viewer_state import ViewerState
+from sic.story_rows import load_story_rows
+from sic.templatetags.comment import iter_rendered_comments
 
 
-def story(request, story_pk, slug=None):
+def story(request, story_pk, slug=None, comment_pk=None):
     try:
         story_obj = Story.objects.get(pk=story_pk)
     except Story.DoesNotExist:
         raise Http404("Story does not exist") from Story.DoesNotExist
+    thread_root = None
+    if comment_pk is not None:
+        try:
+            thread_root = story_obj.active_comments.get(pk=comment_pk)
+        except Comment.DoesNotExist:
+            raise Http404("Comment does not exist") from Comment.DoesNotExist
     media = None
     if story_obj.media_sha256 is not None:
         from sic.s3 import BucketObject
 
         obj = BucketObject.from_sha256(story_obj.media_sha256)
         if obj:
-            media = obj.url()
+            try:
+                media = obj.url()
+            except Exception:
+                logger.warning(
+                    "could not presign media of story %s", story_obj.pk, exc_info=True
+                )
 
     ongoing_reply_pk = None
     try:
@@ -87,20 +116,66 @@ def story(request, story_pk, slug=None):
             )
     else:
         if slug != story_obj.slugify:
+            if thread_root is not None:
+                return redirect(
+                    "story_thread",
+                    story_pk=story_obj.pk,
+                    slug=story_obj.slugify,
+                    comment_pk=thread_root.pk,
+                )
             return redirect(story_obj.get_absolute_url())
         form = SubmitCommentForm()
-    comments = story_obj.active_comments.prefetch_related("user", "votes")
-    return render(
-        request,
+    if thread_root is not None:
+        comments = thread_root.subthread(max_depth=config.COMMENT_THREAD_MAX_DEPTH)
+    else:
+        comments = story_obj.comment_thread(max_depth=config.COMMENT_THREAD_MAX_DEPTH)
+    comments = comments.prefetch_related("user", "votes")
+    ViewerState.of(request.user).preload(stories=[story_obj], comments=comments)
+    context = {
+        "story": story_obj,
+        "media": media,
+        "comment_form": form,
+        "comments": comments,
+        "thread_root": thread_root,
+        "ongoing_reply_pk": ongoing_reply_pk,
+    }
+    if config.STREAM_STORY_PAGES:
+        return stream_story(request, context)
+    return render(request, "posts/story.html", context)
+
+
+def stream_story(request, context):
+    """Send the story page up to its comments right away, then each comment
+    thread as soon as it is rendered.
+
+    Everything but the comments is rendered before returning, so that
+    middleware sees the session, messages and CSRF token used by the page."""
+    marker = f"<!-- comments-{uuid.uuid4().hex} -->"
+    html = render_to_string(
         "posts/story.html",
-        {
-            "story": story_obj,
-            "media": media,
-            "comment_form": form,
-            "comments": comments,
-            "ongoing_reply_pk": ongoing_reply_pk,
-        },
+        {**context, "stream_comments": mark_safe(marker)},
+        request,
     )
+    head, tail = html.split(marker, 1)
+    if request.user.is_authenticated:
+        # Comment reply forms need the CSRF cookie.
+        get_token(request)
+    comments_context = make_context(context, request)
+    template = get_template("posts/comment.html").template
+
+    def stream():
+        yield head
+        with comments_context.bind_template(template):
+            yield from iter_rendered_comments(
+                comments_context,
+                request,
+                context["comments"],
+                None,
+                root=context["thread_root"],
+            )
+        yield tail
+
+    return StreamingHttpResponse(stream())
 
 
 def all_stories_tmpl(request, view_name, json_response, page_num=1):
@@ -174,6 +249,7 @@ def all_stories_tmpl(request, view_name, json_response, page_num=1):
             }
         )
 
+    load_story_rows(page, request.user)
     return render(
         request,
         "posts/all_stories.html",
@@ -215,6 +291,12 @@ def submit_story(request):
                 "publish_date": form.cleaned_data["publish_date"],
                 "tags": form.cleaned_data["tags"],
             }
+            for duplicate in recent_duplicate_titles(form.cleaned_data["title"]):
+                messages.add_message(
+                    request,
+                    messages.WARNING,
+                    f"A {config.model_verbose_names('story', False)} with a similar title was submitted recently: {duplicate.title}",
+                )
         else:
             form = SubmitStoryForm(request.POST, request.FILES)
             form.fields["title"].required = True
@@ -239,13 +321,10 @@ def submit_story(request):
                         "media_sha256": media_sha256,
                     }
 
-                    story_hash = blockchain.upload_story(
-                        user.birth_hash, json.dumps(blockchain_data)
-                    )
+                    payload = json.dumps(blockchain_data)
 
                     new_story = Story.objects.create(
                         media_sha256=media_sha256,
-                        story_hash=story_hash,
                         title=title,
                         publish_date=publish_date,
                         content=content,
@@ -256,6 +335,15 @@ def submit_story(request):
                     new_story.tags.set(form.cleaned_data["tags"])
                     new_story.kind.set(form.cleaned_data["kind"])
                     new_story.save()
+                    anchoring.enqueue_story(new_story, payload)
+                    for duplicate in recent_duplicate_titles(
+                        title, exclude_pk=new_story.pk
+                    ):
+                        messages.add_message(
+                            request,
+                            messages.WARNING,
+                            f"A {config.model_verbose_names('story', False)} with a similar title was submitted recently: {duplicate.title}",
+                        )
                     return redirect(new_story.get_absolute_url())
                 except Exception as exc:
                     messages.add_message(
@@ -303,24 +391,16 @@ def upvote_story(request, story_pk):
                     request, messages.ERROR, "You cannot vote on your own posts."
                 )
             else:
+                # Votes are anchored in batches, see sic/anchoring.py
                 vote, created = user.votes.get_or_create(
-                    story=story_obj, comment=None, user=user
+                    story=story_obj,
+                    comment=None,
+                    user=user,
+                    defaults={"anchor_pending": True},
                 )
                 # if not created: Can't delete!
                 #    vote.delete()
-                print(vote, created)
-                if created:
-                    blockchain_data = {
-                        "type": "petmypet",
-                        "target_birth_hash": story_obj.user.birth_hash,
-                        "story_hash": story_obj.story_hash,
-                        "date": vote.created.isoformat(),
-                    }
-                    vote_hash = blockchain.upload_story(
-                        user.birth_hash, json.dumps(blockchain_data)
-                    )
-                    vote.vote_hash = vote_hash
-                    vote.save()
+                logger.debug("story vote %s, created: %s", vote.pk, created)
     if "next" in request.GET and check_next_url(request.GET["next"]):
         return redirect(request.GET["next"])
     return redirect(reverse("index"))
@@ -35,6 +35,7 @@ from sic.views.utils import (
     check_next_url,
 )
 from sic.moderation import ModerationLogEntry
+from sic.story_rows import load_story_rows
 
 
 def browse_tags(request, page_num=1):
@@ -332,6 +333,7 @@ def view_tag(request, tag_pk, slug=None, page_num=1):
         fields=view_tag.ORDER_BY_FIELDS,
         initial={"order_by": order_by, "ordering": ordering},
     )
+    load_story_rows(page, request.user)
     return render(
         request,
         "posts/all_stories.html",